@@ -0,0 +1,279 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local stand-in for the Data Commons query endpoint, for load tests.
+
+It serves the `toolformer_rig` (point) and `toolformer_rag` (table) modes
+with synthetic charts in the shape `DataCommons` parses, deterministic per
+query, and injects latency, errors and bursts of 429s.
+
+  python benchmarks/fake_dc_server.py --port 8080 --latency-ms 80 \\
+      --error-rate 0.01 --throttle-every-secs 10 --throttle-secs 1
+
+  dc = datacommons.DataCommons(
+      api_key='', base_url='http://127.0.0.1:8080/nodejs/query'
+  )
+"""
+
+import argparse
+import collections
+import dataclasses
+import http.server
+import json
+import math
+import random
+import threading
+import time
+from typing import Any
+import urllib.parse
+import zlib
+
+_PATH = '/nodejs/query'
+_POINT_MODE = 'toolformer_rig'
+_TABLE_MODE = 'toolformer_rag'
+
+
+@dataclasses.dataclass
+class FaultConfig:
+  """Latency and failures to inject into responses."""
+
+  # Median latency, log-normally distributed with shape `latency_sigma`
+  # (0 for a fixed latency).
+  latency_ms: float = 50.0
+  latency_sigma: float = 0.5
+  # A fraction of requests that take an extra `tail_ms` (stragglers).
+  tail_rate: float = 0.0
+  tail_ms: float = 1000.0
+  # A fraction of requests that fail with a 500.
+  error_rate: float = 0.0
+  # A fraction of queries with no matching chart.
+  no_data_rate: float = 0.0
+  # For the first `throttle_secs` of every `throttle_every_secs`, requests
+  # get a 429 with `Retry-After: retry_after_secs`.  0 disables throttling.
+  throttle_every_secs: float = 0.0
+  throttle_secs: float = 1.0
+  retry_after_secs: int = 1
+  # Rows and year columns of table responses.
+  table_rows: int = 10
+  table_years: int = 5
+  seed: int | None = None
+
+
+class FakeDataCommons:
+  """A threaded HTTP server answering Data Commons queries.
+
+  Use as a context manager, or call `start` and `stop`.
+  """
+
+  def __init__(
+      self,
+      config: FaultConfig | None = None,
+      host: str = '127.0.0.1',
+      port: int = 0,
+  ):
+    self.config = config or FaultConfig()
+    self._rnd = random.Random(self.config.seed)
+    self._rnd_lock = threading.Lock()
+    self._start_secs = time.time()
+    self._stats: collections.Counter[str] = collections.Counter()
+    self._stats_lock = threading.Lock()
+    handler = type('_BoundHandler', (_Handler,), {'server_state': self})
+    self.httpd = http.server.ThreadingHTTPServer((host, port), handler)
+    self.httpd.daemon_threads = True
+    self._thread: threading.Thread | None = None
+
+  @property
+  def url(self) -> str:
+    """The base URL to pass to `DataCommons`."""
+    host, port = self.httpd.server_address[:2]
+    return f'http://{host}:{port}{_PATH}'
+
+  def start(self) -> 'FakeDataCommons':
+    self._thread = threading.Thread(
+        target=self.httpd.serve_forever, name='fake-dc', daemon=True
+    )
+    self._thread.start()
+    return self
+
+  def stop(self) -> None:
+    self.httpd.shutdown()
+    self.httpd.server_close()
+    if self._thread:
+      self._thread.join()
+
+  def __enter__(self) -> 'FakeDataCommons':
+    return self.start()
+
+  def __exit__(self, *args) -> None:
+    self.stop()
+
+  def stats(self) -> dict[str, int]:
+    """Returns the number of responses by status code, and by mode."""
+    with self._stats_lock:
+      return dict(self._stats)
+
+  def respond(self, params: dict[str, str]) -> tuple[int, dict[str, str], Any]:
+    """Returns the status, headers and JSON body for the query params."""
+    cfg = self.config
+    with self._rnd_lock:
+      latency = cfg.latency_ms * math.exp(
+          cfg.latency_sigma * self._rnd.gauss(0, 1)
+      )
+      if self._rnd.random() < cfg.tail_rate:
+        latency += cfg.tail_ms
+      failed = self._rnd.random() < cfg.error_rate
+    time.sleep(latency / 1000)
+
+    mode = params.get('mode', '')
+    query = params.get('q', '')
+    if cfg.throttle_every_secs:
+      phase = (time.time() - self._start_secs) % cfg.throttle_every_secs
+      if phase < cfg.throttle_secs:
+        return self._count(
+            429,
+            mode,
+            {'Retry-After': str(cfg.retry_after_secs)},
+            {'error': 'Too many requests'},
+        )
+    if failed:
+      return self._count(500, mode, {}, {'error': 'Injected failure'})
+    if mode not in (_POINT_MODE, _TABLE_MODE) or not query:
+      return self._count(400, mode, {}, {'error': 'Needs q and a known mode'})
+
+    rnd = random.Random(zlib.crc32(query.encode()))
+    if rnd.random() < cfg.no_data_rate:
+      return self._count(200, mode, {}, {'charts': []})
+    if mode == _POINT_MODE:
+      return self._count(200, mode, {}, _point_response(query, rnd))
+    return self._count(200, mode, {}, _table_response(query, rnd, cfg))
+
+  def _count(self, status, mode, headers, body):
+    with self._stats_lock:
+      self._stats[str(status)] += 1
+      if mode:
+        self._stats[mode] += 1
+    return status, headers, body
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  """Serves GET `_PATH` from `server_state`."""
+
+  server_state: FakeDataCommons
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    url = urllib.parse.urlsplit(self.path)
+    if url.path != _PATH:
+      status, headers, body = 404, {}, {'error': f'Unknown path {url.path}'}
+    else:
+      params = dict(urllib.parse.parse_qsl(url.query))
+      status, headers, body = self.server_state.respond(params)
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, *args):
+    pass
+
+
+def _debug(query: str, rnd: random.Random) -> dict[str, Any]:
+  var = 'Count_' + '_'.join(w.capitalize() for w in query.split()[:3])
+  return {'debug': {'sv_matching': {
+      'CosineScore': [round(rnd.uniform(0.6, 1.0), 4)],
+      'SV': [var],
+  }}}
+
+
+def _point_response(query: str, rnd: random.Random) -> dict[str, Any]:
+  return {
+      'charts': [{
+          'type': 'LINE',
+          'title': f'Synthetic statistic for "{query}"',
+          'unit': rnd.choice(['', 'USD', 'Years']),
+          'highlight': {
+              'value': round(rnd.uniform(0, 1e7), rnd.choice([0, 2])),
+              'date': str(rnd.randrange(2010, 2024)),
+          },
+          'srcs': [{'name': 'Synthetic Source'}],
+          'dcUrl': 'https://datacommons.org/explore#q='
+          + urllib.parse.quote(query),
+      }],
+      'debug': _debug(query, rnd),
+  }
+
+
+def _table_response(
+    query: str, rnd: random.Random, cfg: FaultConfig
+) -> dict[str, Any]:
+  years = [str(2024 - cfg.table_years + i) for i in range(cfg.table_years)]
+  lines = [','.join(['place'] + years)]
+  for r in range(cfg.table_rows):
+    values = [f'{rnd.uniform(0, 1e6):.6f}' for _ in years]
+    lines.append(','.join([f'Place {r}'] + values))
+  return {
+      'charts': [{
+          'type': 'TABLE',
+          'title': f'Synthetic table for "{query}"',
+          'unit': rnd.choice(['', 'USD']),
+          'data_csv': '\n'.join(lines),
+          'srcs': [{'name': 'Synthetic Source'}],
+          'dcUrl': 'https://datacommons.org/explore#q='
+          + urllib.parse.quote(query),
+      }],
+      'debug': _debug(query, rnd),
+  }
+
+
+def add_fault_args(parser: argparse.ArgumentParser) -> None:
+  """Adds a flag per `FaultConfig` field to parser."""
+  for f in dataclasses.fields(FaultConfig):
+    flag = '--' + f.name.replace('_', '-')
+    if f.name == 'seed':
+      parser.add_argument(flag, type=int, default=None)
+    else:
+      parser.add_argument(flag, type=type(f.default), default=f.default)
+
+
+def config_from_args(args: argparse.Namespace) -> FaultConfig:
+  return FaultConfig(
+      **{f.name: getattr(args, f.name) for f in dataclasses.fields(FaultConfig)}
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  add_fault_args(parser)
+  args = parser.parse_args()
+
+  server = FakeDataCommons(config_from_args(args), args.host, args.port)
+  print(f'Serving fake Data Commons at {server.url}')
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.httpd.server_close()
+    print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == '__main__':
+  main()
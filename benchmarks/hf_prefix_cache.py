@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks and times `HFBasic(prefix_cache=True)` on CPU.
+
+Uses a small randomly initialized GPT-2 and a BPE tokenizer trained on
+`prompts`, so it needs torch, transformers and tokenizers but no download.
+Greedy outputs, from `query` and `query_stream`, must match those without
+the prefix cache.
+
+Usage: python benchmarks/hf_prefix_cache.py [--layers 4] [--new-tokens 8]
+"""
+
+import argparse
+import time
+
+import tokenizers
+from tokenizers import decoders
+from tokenizers import models
+from tokenizers import pre_tokenizers
+from tokenizers import trainers
+import torch
+import transformers
+
+from data_gemma import base
+from data_gemma import huggingface_api
+from data_gemma import prompts
+
+_QUERIES = [
+    'What is the population of California?',
+    'How has the unemployment rate in Texas changed since 2010?',
+    'Which counties in Nevada have the highest median income?',
+]
+
+
+def make_model(
+    num_layers: int, dim: int
+) -> tuple[transformers.PreTrainedModel, transformers.PreTrainedTokenizerFast]:
+  """Returns a random GPT-2 and a tokenizer trained on the prompt templates."""
+  tok = tokenizers.Tokenizer(models.BPE(unk_token='<unk>'))
+  tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+  tok.decoder = decoders.ByteLevel()
+  trainer = trainers.BpeTrainer(
+      vocab_size=2000,
+      special_tokens=['<unk>', '<eos>'],
+      initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+  )
+  texts = [v for k, v in vars(prompts).items() if k.isupper()]
+  tok.train_from_iterator(texts + _QUERIES, trainer)
+  tokenizer = transformers.PreTrainedTokenizerFast(
+      tokenizer_object=tok, eos_token='<eos>', unk_token='<unk>'
+  )
+
+  torch.manual_seed(0)
+  config = transformers.GPT2Config(
+      vocab_size=len(tokenizer),
+      n_positions=4096,
+      n_embd=dim,
+      n_layer=num_layers,
+      n_head=4,
+      bos_token_id=tokenizer.eos_token_id,
+      eos_token_id=tokenizer.eos_token_id,
+  )
+  model = transformers.GPT2LMHeadModel(config).eval()
+  model.generation_config.pad_token_id = tokenizer.eos_token_id
+  return model, tokenizer
+
+
+def make_prompts() -> list[str]:
+  out = []
+  for q in _QUERIES:
+    out.append(prompts.RAG_IN_CONTEXT_PROMPT.format(sentence=q))
+    out.append(prompts.RIG_IN_CONTEXT_PROMPT.format(text=f'{q} It is 42.'))
+    out.append(
+        prompts.DC_QA_VALIDATION.format(
+            input=f'[[QA1]]:\n  Question: {q}\n  Answer: 42'
+        )
+    )
+  return out
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--layers', type=int, default=4)
+  parser.add_argument('--dim', type=int, default=256)
+  parser.add_argument('--new-tokens', type=int, default=8)
+  parser.add_argument('--reps', type=int, default=3)
+  args = parser.parse_args()
+
+  huggingface_api.MAX_NEW_TOKENS = args.new_tokens
+  model, tokenizer = make_model(args.layers, args.dim)
+  plain = huggingface_api.HFBasic(model, tokenizer, verbose=False, device='cpu')
+  cached = huggingface_api.HFBasic(
+      model, tokenizer, verbose=False, device='cpu', prefix_cache=True
+  )
+  all_prompts = make_prompts()
+
+  # Computes the prefix KVs, and checks the outputs are unchanged, also when
+  # streamed.
+  for p in all_prompts:
+    want, got = plain.query(p).response, cached.query(p).response
+    assert want == got, (want, got)
+    for llm in (plain, cached):
+      *chunks, call = llm.query_stream(p)
+      assert isinstance(call, base.LLMCall) and not call.error, call
+      assert call.response == ''.join(chunks) == want, (call.response, want)
+      assert call.ttft_secs is not None or not want
+  print(
+      f'{len(all_prompts)} prompts match; reused'
+      f' {cached.reused_prefix_tokens / cached.prefix_hits:.0f} of'
+      f' ~{len(tokenizer(all_prompts[0])["input_ids"])} tokens per prompt'
+  )
+
+  for name, llm in [('no prefix cache', plain), ('prefix cache', cached)]:
+    start = time.time()
+    for _ in range(args.reps):
+      for p in all_prompts:
+        llm.query(p)
+    secs = (time.time() - start) / (args.reps * len(all_prompts))
+    print(f'{name:<16} {secs * 1e3:8.1f}ms per call')
+
+
+if __name__ == '__main__':
+  main()
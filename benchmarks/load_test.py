@@ -0,0 +1,196 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Open-loop load test of RIGFlow or RAGFlow against a fake Data Commons.
+
+Queries arrive at --qps regardless of how many are still running, and
+latencies are measured from each query's scheduled start, so a backlog
+shows up in the percentiles.  The LLMs are synthetic, with a fixed
+latency, and emit DC markers (RIG) or questions (RAG) drawn from a pool of
+--distinct-queries.  Unless --dc-url is given, a `fake_dc_server` is
+started in-process with the fault flags.
+
+Usage:
+  python benchmarks/load_test.py --flow rig --qps 20 --duration-secs 30 \\
+      --latency-ms 100 --error-rate 0.02 --throttle-every-secs 10
+"""
+
+import argparse
+import concurrent.futures
+import json
+import random
+import threading
+import time
+
+from data_gemma import base
+from data_gemma import datacommons
+from data_gemma import metrics
+from data_gemma import rag
+from data_gemma import rig
+import fake_dc_server
+
+
+class _SyntheticLLM(base.LLM):
+  """An LLM that sleeps, then answers with DC markers or questions."""
+
+  def __init__(
+      self, kind: str, latency_secs: float, queries: list[str], per_answer: int
+  ):
+    self.kind = kind
+    self.latency_secs = latency_secs
+    self.queries = queries
+    self.per_answer = per_answer
+    self._rnd = random.Random(0)
+    self._lock = threading.Lock()
+
+  def query(self, prompt: str) -> base.LLMCall:
+    start = time.time()
+    time.sleep(self.latency_secs)
+    with self._lock:
+      picks = self._rnd.sample(self.queries, self.per_answer)
+    if self.kind == 'questions':
+      text = '\n'.join(picks)
+    elif self.kind == 'markers':
+      text = ' '.join(
+          f'The value is [__DC__("{q}") --> "{i * 100}"].'
+          for i, q in enumerate(picks)
+      )
+    else:
+      text = 'A synthetic answer based on the tables.'
+    return base.LLMCall(
+        prompt=prompt,
+        response=text,
+        duration_secs=round(time.time() - start, 3),
+    )
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+  if not sorted_values:
+    return float('nan')
+  i = min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))
+  return sorted_values[i]
+
+
+def run(args: argparse.Namespace, dc_url: str) -> dict[str, float]:
+  """Drives the flow at args.qps for args.duration_secs, returning stats."""
+  pool = [
+      f'what is the {stat} of place {p}'
+      for stat in ('population', 'median income', 'unemployment rate')
+      for p in range(args.distinct_queries // 3 + 1)
+  ][:args.distinct_queries]
+  llm_secs = args.llm_latency_ms / 1000
+  dc = datacommons.DataCommons(
+      api_key='',
+      verbose=False,
+      num_threads=args.dc_threads,
+      base_url=dc_url,
+      timeout_secs=args.dc_timeout_secs,
+  )
+  if args.flow == 'rig':
+    flow = rig.RIGFlow(
+        llm=_SyntheticLLM('markers', llm_secs, pool, args.dc_per_query),
+        data_fetcher=dc,
+        verbose=False,
+    )
+  else:
+    flow = rag.RAGFlow(
+        llm_question=_SyntheticLLM(
+            'questions', llm_secs, pool, args.dc_per_query
+        ),
+        llm_answer=_SyntheticLLM('answer', llm_secs, pool, 0),
+        data_fetcher=dc,
+        verbose=False,
+    )
+
+  latencies = []
+  counts = {'ok': 0, 'flow_errors': 0, 'dc_calls': 0, 'dc_call_errors': 0}
+  lock = threading.Lock()
+
+  def _one(i: int, scheduled: float) -> None:
+    try:
+      resp = flow.query(f'Synthetic query {i}')
+    except Exception:  # pylint: disable=broad-exception-caught
+      with lock:
+        counts['flow_errors'] += 1
+      return
+    latency = time.time() - scheduled
+    with lock:
+      latencies.append(latency)
+      counts['ok'] += 1
+      counts['dc_calls'] += len(resp.dc_calls)
+      counts['dc_call_errors'] += sum(1 for c in resp.dc_calls if c.error)
+
+  num_queries = int(args.qps * args.duration_secs)
+  start = time.time()
+  with concurrent.futures.ThreadPoolExecutor(args.max_in_flight) as executor:
+    for i in range(num_queries):
+      scheduled = start + i / args.qps
+      time.sleep(max(0.0, scheduled - time.time()))
+      executor.submit(_one, i, scheduled)
+  wall_secs = time.time() - start
+  dc.close()
+
+  latencies.sort()
+  return dict(
+      counts,
+      sent=num_queries,
+      wall_secs=round(wall_secs, 3),
+      throughput_qps=round(counts['ok'] / wall_secs, 2),
+      p50_secs=round(_percentile(latencies, 50), 3),
+      p90_secs=round(_percentile(latencies, 90), 3),
+      p99_secs=round(_percentile(latencies, 99), 3),
+      max_secs=round(latencies[-1] if latencies else float('nan'), 3),
+  )
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--flow', choices=['rig', 'rag'], default='rig')
+  parser.add_argument('--qps', type=float, default=10)
+  parser.add_argument('--duration-secs', type=float, default=10)
+  parser.add_argument('--max-in-flight', type=int, default=256)
+  parser.add_argument('--llm-latency-ms', type=float, default=200)
+  parser.add_argument('--dc-per-query', type=int, default=5)
+  parser.add_argument('--distinct-queries', type=int, default=300)
+  parser.add_argument('--dc-threads', type=int, default=8)
+  parser.add_argument('--dc-timeout-secs', type=float, default=10)
+  parser.add_argument('--dc-url', help='Use this server, not an in-process one.')
+  fake_dc_server.add_fault_args(parser)
+  args = parser.parse_args()
+
+  server = None
+  dc_url = args.dc_url
+  if not dc_url:
+    server = fake_dc_server.FakeDataCommons(
+        fake_dc_server.config_from_args(args)
+    ).start()
+    dc_url = server.url
+  try:
+    stats = run(args, dc_url)
+  finally:
+    if server:
+      server.stop()
+
+  print(json.dumps(stats, indent=2))
+  if server:
+    print('Server responses:', json.dumps(server.stats()))
+  print(
+      'DC HTTP attempts:',
+      json.dumps(metrics.to_dict().get('data_gemma_dc_http_requests_total')),
+  )
+
+
+if __name__ == '__main__':
+  main()
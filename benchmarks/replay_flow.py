@@ -0,0 +1,86 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Replays a recorded run of RIGFlow or RAGFlow, for before/after timings.
+
+The queries file has one query per line, as in the recorded run (see
+`data_gemma.cassette`), whose RAG LLMs were named 'question' and 'answer'.
+Without --realtime, LLM and DC calls are instant, which times the flow's
+own overhead; with it, they take their recorded latencies, which times
+end-to-end effects such as overlapping calls.
+
+Usage:
+  python benchmarks/replay_flow.py --cassette run.json.gz \\
+      --queries queries.txt --flow rig [--realtime] [--reps 5]
+"""
+
+import argparse
+import json
+import time
+
+from data_gemma import cassette
+from data_gemma import rag
+from data_gemma import rig
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--cassette', required=True)
+  parser.add_argument('--queries', required=True)
+  parser.add_argument('--flow', choices=['rig', 'rag'], default='rig')
+  parser.add_argument('--realtime', action='store_true')
+  parser.add_argument('--reps', type=int, default=1)
+  parser.add_argument('--dc-threads', type=int, default=1)
+  args = parser.parse_args()
+
+  with open(args.queries) as f:
+    queries = [q.strip() for q in f if q.strip()]
+
+  tape = cassette.Cassette(args.cassette, realtime=args.realtime)
+  dc = cassette.CassetteDataCommons(
+      tape, verbose=False, num_threads=args.dc_threads
+  )
+  if args.flow == 'rig':
+    flow = rig.RIGFlow(
+        llm=cassette.CassetteLLM(tape), data_fetcher=dc, verbose=False
+    )
+  else:
+    flow = rag.RAGFlow(
+        llm_question=cassette.CassetteLLM(tape, name='question'),
+        llm_answer=cassette.CassetteLLM(tape, name='answer'),
+        data_fetcher=dc,
+        verbose=False,
+    )
+
+  secs = []
+  for _ in range(args.reps):
+    start = time.time()
+    for q in queries:
+      flow.query(q)
+    secs.append(time.time() - start)
+  dc.close()
+
+  print(json.dumps({
+      'queries': len(queries),
+      'best_secs': round(min(secs), 4),
+      'mean_secs': round(sum(secs) / len(secs), 4),
+      'cassette': tape.stats(),
+  }, indent=2))
+  if tape.stats()['misses']:
+    print('Some calls were not in the cassette; the flow or queries differ.')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,157 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmark of `RIGFlow._evaluate` against the original version.
+
+Usage: python benchmarks/rig_evaluate.py [--markers 10,50,200] [--reps 50]
+"""
+
+import argparse
+import copy
+import random
+import timeit
+
+from data_gemma import base
+from data_gemma import rig
+
+_FILLER = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+
+def legacy_evaluate(
+    text: str,
+    q2llmval: dict[str, list[str]],
+    q2resp: dict[str, base.DataCommonsCall],
+) -> tuple[str, list[str], list[base.DataCommonsCall]]:
+  """The replace-per-marker `_evaluate`, kept for comparison."""
+
+  def _rtag(txt: str, r: base.DataCommonsCall) -> str:
+    return f'[{base.DC}#{r.id}({txt})]'
+
+  dc_calls = []
+  footnote_map = {}
+  for q, orig_resp in q2resp.items():
+    llm_vals = q2llmval[q]
+
+    for llmval in llm_vals:
+      resp = copy.deepcopy(orig_resp)
+
+      resp.id = len(dc_calls) + 1
+      resp.llm_val = llmval
+      dcval = resp.val_and_unit()
+
+      idx = -1
+      if dcval:
+        idx = len(footnote_map) + 1
+        if q not in footnote_map:
+          footnote_map[q] = (idx, f'[{idx}] - {resp.footnote()}')
+        else:
+          idx = footnote_map[q][0]
+
+      orig = f'[__DC__("{q}") --> "{llmval}"]'
+      if not llmval:
+        if dcval:
+          new = f'{dcval} [{idx}] ||'
+        else:
+          new = '--- || ---'
+        text = text.replace(orig, _rtag(new, resp), 1)
+      elif dcval:
+        if rig._flag_value(resp.val, llmval):  # pylint: disable=protected-access
+          new = f'{dcval} [{idx}]* || {llmval}'
+        else:
+          new = f'{dcval} [{idx}] || {llmval}'
+        text = text.replace(orig, _rtag(new, resp), 1)
+      else:
+        new = f'|| {llmval}'
+        text = text.replace(orig, _rtag(new, resp), 1)
+
+      dc_calls.append(resp)
+
+  footnotes = [
+      v[1] for v in sorted(footnote_map.values(), key=lambda x: x[0])
+  ]
+
+  return text, footnotes, dc_calls
+
+
+def make_input(
+    num_markers: int, seed: int = 0
+) -> tuple[str, dict[str, list[str]], dict[str, base.DataCommonsCall]]:
+  """Returns an annotated text with repeated, empty and unclosed markers."""
+  rnd = random.Random(seed)
+  num_queries = max(1, num_markers // 2)
+  parts = []
+  for i in range(num_markers):
+    q = f'what is stat {rnd.randrange(num_queries)} of place {i % 7}'
+    val = rnd.choice(['', f'{rnd.randrange(1000)}', '3.5 million'])
+    closing = ']' if rnd.random() > 0.05 else ''
+    parts.append(_FILLER * rnd.randrange(1, 4))
+    parts.append(f'[__DC__("{q}") --> "{val}"{closing}')
+  parts.append(_FILLER)
+  text = ''.join(parts)
+
+  q2llmval = rig._dc_markers(text)  # pylint: disable=protected-access
+  q2resp = {}
+  for i, q in enumerate(q2llmval):
+    if i % 5 == 4:
+      # A DC call without data.
+      q2resp[q] = base.DataCommonsCall(query=q)
+    else:
+      q2resp[q] = base.DataCommonsCall(
+          id=i + 1,
+          query=q,
+          val=str(rnd.randrange(1000)),
+          date='2020',
+          unit='USD' if i % 2 else '',
+          title=f'Stat {i}',
+          src='Example Source',
+          url=f'https://datacommons.org/{i}',
+      )
+  return text, q2llmval, q2resp
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--markers', default='10,50,200')
+  parser.add_argument('--reps', type=int, default=50)
+  args = parser.parse_args()
+
+  flow = rig.RIGFlow(llm=None, data_fetcher=None, verbose=False)
+  evaluate = flow._evaluate  # pylint: disable=protected-access
+  for num_markers in [int(n) for n in args.markers.split(',')]:
+    text, q2llmval, q2resp = make_input(num_markers)
+
+    # Same output, except for the new segments.
+    new_text, footnotes, dc_calls, segments = evaluate(
+        text, q2llmval, q2resp
+    )
+    assert (new_text, footnotes, dc_calls) == legacy_evaluate(
+        text, q2llmval, q2resp
+    )
+    assert ''.join(new_text[s.start:s.end] for s in segments) == new_text
+
+    old_secs = timeit.timeit(
+        lambda: legacy_evaluate(text, q2llmval, q2resp), number=args.reps
+    )
+    new_secs = timeit.timeit(
+        lambda: evaluate(text, q2llmval, q2resp), number=args.reps
+    )
+    print(
+        f'markers={num_markers:<5} text={len(text):<7}'
+        f' legacy={old_secs / args.reps * 1e3:8.3f}ms'
+        f' single_pass={new_secs / args.reps * 1e3:8.3f}ms'
+        f' speedup={old_secs / new_secs:5.1f}x'
+    )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,252 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Offline micro-benchmarks of the data_gemma hot paths.
+
+Each benchmark reports ops/sec (best of --repeat timed runs) and the peak
+bytes allocated by a single op, measured with tracemalloc.  Results are
+saved as JSON, and compared against an earlier file with --baseline, which
+exits non-zero if any benchmark regressed beyond --tolerance.
+
+Usage:
+  python benchmarks/suite.py --output bench.json
+  python benchmarks/suite.py --baseline bench.json [--filter rig.]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+from data_gemma import base
+from data_gemma import datacommons
+from data_gemma import rig
+from data_gemma import utils
+from data_gemma import validate
+import rig_evaluate
+
+_EVALUATE_MARKERS = (1, 10, 100, 500)
+
+
+class _OfflineDataCommons:
+  """Answers every point query from memory, like a fully cached DC."""
+
+  def point(self, query: str) -> base.DataCommonsCall:
+    return base.DataCommonsCall(query=query, val='42', date='2020')
+
+  def calln(
+      self, queries: list[str], fn: Callable[[str], base.DataCommonsCall]
+  ) -> dict[str, base.DataCommonsCall]:
+    return {q: fn(q) for q in queries}
+
+
+def _table_response(num_rows: int, num_cols: int) -> dict[str, Any]:
+  """Returns a `toolformer_rag` response with a num_rows x num_cols CSV."""
+  header = ['place'] + [f'{2000 + c}' for c in range(num_cols - 1)]
+  lines = [','.join(header)]
+  for r in range(num_rows):
+    row = [f'Place {r}'] + [
+        f'{(r * 31 + c * 17) % 1000 / 7:.6f}' if c % 2 else str(r * c)
+        for c in range(num_cols - 1)
+    ]
+    lines.append(','.join(row))
+  return {
+      'charts': [{
+          'data_csv': '\n'.join(lines),
+          'unit': 'USD',
+          'title': 'Synthetic table',
+          'srcs': [{'name': 'Example Source'}],
+          'dcUrl': 'https://datacommons.org/explore#q=synthetic',
+      }],
+      'debug': {'debug': {'sv_matching': {
+          'CosineScore': [0.93], 'SV': ['Count_Person'],
+      }}},
+  }
+
+
+def _flow_response(num_markers: int) -> base.FlowResponse:
+  text, q2llmval, q2resp = rig_evaluate.make_input(num_markers)
+  flow = rig.RIGFlow(llm=None, data_fetcher=None, verbose=False)
+  main_text, footnotes, dc_calls, segments = flow._evaluate(  # pylint: disable=protected-access
+      text, q2llmval, q2resp
+  )
+  llm_calls = [
+      base.LLMCall(prompt=text, response=text, duration_secs=1.5),
+      base.LLMCall(
+          prompt='validate', response='[[QA1]]', duration_secs=0.3, cached=True
+      ),
+  ]
+  return base.FlowResponse(
+      main_text=main_text,
+      footnotes='\n'.join(footnotes),
+      llm_calls=llm_calls,
+      dc_calls=dc_calls,
+      dc_duration_secs=0.8,
+      segments=segments,
+  )
+
+
+def benchmarks() -> dict[str, Callable[[], Any]]:
+  """Returns the benchmarks by name, each a no-argument op."""
+  cases = {}
+
+  flow = rig.RIGFlow(
+      llm=None, data_fetcher=_OfflineDataCommons(), verbose=False
+  )
+  text, _, _ = rig_evaluate.make_input(100)
+  cases['rig.call_dc[100 markers]'] = lambda: flow._call_dc(text)  # pylint: disable=protected-access
+
+  for n in _EVALUATE_MARKERS:
+    args = rig_evaluate.make_input(n)
+    cases[f'rig.evaluate[{n} markers]'] = (
+        lambda args=args: flow._evaluate(*args)  # pylint: disable=protected-access
+    )
+
+  cases['rig.flag_value[scaled]'] = lambda: rig._flag_value(  # pylint: disable=protected-access
+      '3512345', '3.5 million'
+  )
+  cases['rig.flag_value[plain]'] = lambda: rig._flag_value('1,234.5', '1300')  # pylint: disable=protected-access
+
+  for shape, rows, cols in [('wide', 5, 200), ('long', 2000, 3)]:
+    resp = _table_response(rows, cols)
+    cases[f'datacommons.parse_table[{shape} {rows}x{cols}]'] = (
+        lambda resp=resp: datacommons._parse_table('q', resp)  # pylint: disable=protected-access
+    )
+
+  cases['utils.round_float[int]'] = lambda: utils.round_float('123456')
+  cases['utils.round_float[float]'] = lambda: utils.round_float('3.14159265')
+  cases['utils.round_float[text]'] = lambda: utils.round_float('Place 12')
+
+  q2a = {
+      f'what is the population of place {i}': (
+          '' if i % 10 == 9 else f'According to Example, it was {i} in 2020.'
+      )
+      for i in range(50)
+  }
+  queries, _ = validate._dc_qa_validation_input(q2a)  # pylint: disable=protected-access
+  llm_resp = '\n'.join(f'[[QA{i + 1}]]' for i in range(0, len(queries), 2))
+  cases['validate.qa_input[50 pairs]'] = (
+      lambda: validate._dc_qa_validation_input(q2a)  # pylint: disable=protected-access
+  )
+  cases['validate.qa_check[50 pairs]'] = (
+      lambda: validate._dc_qa_validation_check(llm_resp, queries)  # pylint: disable=protected-access
+  )
+
+  response = _flow_response(100)
+  cases['flow_response.json[100 markers]'] = response.json
+  cases['flow_response.debug[100 markers]'] = response.debug
+
+  return cases
+
+
+def measure(fn: Callable[[], Any], repeat: int) -> dict[str, float]:
+  """Returns the ops/sec and peak bytes allocated per op of fn."""
+  timer = timeit.Timer(fn)
+  number, _ = timer.autorange()
+  best = min(timer.repeat(repeat=repeat, number=number))
+
+  tracemalloc.start()
+  try:
+    fn()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+
+  return {
+      'ops_per_sec': number / best,
+      'peak_alloc_bytes': max(0, peak - before),
+  }
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    tolerance: float,
+) -> list[str]:
+  """Prints results against baseline, and returns the regressed names."""
+  regressed = []
+  for name, r in results.items():
+    b = baseline.get(name)
+    if not b:
+      print(f'{name:<42} (not in baseline)')
+      continue
+    speed = r['ops_per_sec'] / b['ops_per_sec']
+    alloc = (r['peak_alloc_bytes'] + 1) / (b['peak_alloc_bytes'] + 1)
+    slower = speed < 1 - tolerance
+    bigger = alloc > 1 + tolerance
+    flag = '  REGRESSED' if slower or bigger else ''
+    print(f'{name:<42} speed={speed:5.2f}x alloc={alloc:5.2f}x{flag}')
+    if flag:
+      regressed.append(name)
+  return regressed
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument('--output', help='Path to save the results as JSON.')
+  parser.add_argument('--baseline', help='Results JSON to compare against.')
+  parser.add_argument(
+      '--tolerance',
+      type=float,
+      default=0.25,
+      help='Allowed fractional slowdown or allocation growth.',
+  )
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--filter', default='', help='Only run names with this.')
+  args = parser.parse_args()
+
+  results = {}
+  for name, fn in benchmarks().items():
+    if args.filter not in name:
+      continue
+    r = measure(fn, args.repeat)
+    results[name] = r
+    print(
+        f'{name:<42} {r["ops_per_sec"]:14,.0f} ops/s'
+        f' {r["peak_alloc_bytes"]:12,} B/op'
+    )
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(
+          {
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'timestamp': time.time(),
+              'results': results,
+          },
+          f,
+          indent=2,
+      )
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+    print(f'\nAgainst {args.baseline} (tolerance {args.tolerance:.0%}):')
+    regressed = compare(results, baseline, args.tolerance)
+    if regressed:
+      print(f'{len(regressed)} benchmark(s) regressed.')
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
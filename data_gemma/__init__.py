@@ -13,17 +13,25 @@
 # limitations under the License.
 
 from data_gemma import base
+from data_gemma import batch
 from data_gemma import baseline
+from data_gemma import cache
+from data_gemma import cassette
 from data_gemma import datacommons
 from data_gemma import google_api
 from data_gemma import huggingface_api
+from data_gemma import metrics
 from data_gemma import openai_api
 from data_gemma import rag
+from data_gemma import retrieval
 from data_gemma import rig
+from data_gemma import tracing
 
 # LLM related classes.
 LLM = base.LLM
 LLMCall = base.LLMCall
+CachedLLM = cache.CachedLLM
+CassetteLLM = cassette.CassetteLLM
 GoogleAIStudio = google_api.GoogleAIStudio
 HFBasic = huggingface_api.HFBasic
 HFPipeline = huggingface_api.HFPipeline
@@ -32,10 +40,14 @@ OpenAI = openai_api.OpenAI
 # Data Commons related classes.
 DataCommons = datacommons.DataCommons
 DataCommonsCall = base.DataCommonsCall
+DCCache = cache.DCCache
+CassetteDataCommons = cassette.CassetteDataCommons
 
 # Flow related classes.
 Flow = base.Flow
 FlowResponse = base.FlowResponse
 BaselineFlow = baseline.BaselineFlow
 RAGFlow = rag.RAGFlow
+BM25Index = retrieval.BM25Index
 RIGFlow = rig.RIGFlow
+run_batch = batch.run_batch
@@ -14,8 +14,13 @@
 
 """Base Types."""
 
+import asyncio
 import dataclasses
-from typing import Any, Protocol
+import time
+from typing import Any, Awaitable, Callable, Iterator, Protocol
+
+from data_gemma import metrics
+from data_gemma import tracing
 
 
 DC = '__DC__'
@@ -38,12 +43,21 @@ class LLMCall:
   response: str
   duration_secs: float
   error: str | None = None
+  # Time to first token, set for streamed calls.
+  ttft_secs: float | None = None
+  # Served from a cache; `duration_secs` is then that of the original call.
+  cached: bool = False
 
   def debug(self, i: int = 0) -> str:
+    ttft = ''
+    if self.ttft_secs is not None:
+      ttft = f' (TTFT {self.ttft_secs}s)'
+    if self.cached:
+      ttft += ' (cached)'
     return (
         f'\n### Prompt {i} ###\n{self.prompt}\n'
         f'### Response {i} ###\n{self.response}\n'
-        f'### LLM Duration {i} {self.duration_secs}s ###\n'
+        f'### LLM Duration {i} {self.duration_secs}s{ttft} ###\n'
     )
 
 
@@ -70,6 +84,9 @@ class DataCommonsCall:
   # The original LLM Value in case of RIG.
   llm_val: str = ''
 
+  # Set if the call failed, in which case there is no data.
+  error: str = ''
+
   def footnote(self) -> str:
     return (
         f'Per {self.src}, value was {self.val}{self._dunit()} in {self.date}.'
@@ -77,6 +94,8 @@ class DataCommonsCall:
     )
 
   def debug(self) -> str:
+    if self.error:
+      return f'"{self.query}" failed: {self.error}'
     if not self.title:
       return ''
     if self.table:
@@ -112,6 +131,19 @@ class DataCommonsCall:
     return ' ' + self.unit if self.unit else ''
 
 
+@dataclasses.dataclass(frozen=True)
+class Segment:
+  """A span of `FlowResponse.main_text`, either plain or DC annotated."""
+
+  # The plain text, or for an annotation the text inside its tag.
+  text: str
+  # Offsets of the whole span, including any tag, in `main_text`.
+  start: int
+  end: int
+  # The `DataCommonsCall.id` of an annotation, or 0 for plain text.
+  dc_call_id: int = 0
+
+
 @dataclasses.dataclass(frozen=True)
 class FlowResponse:
   """A response from Flow."""
@@ -124,11 +156,20 @@ class FlowResponse:
   dc_calls: list[DataCommonsCall] = dataclasses.field(default_factory=list)
   dc_duration_secs: float = 0.0
 
+  # The structure of `main_text`, for flows that annotate it (RIG).
+  segments: list[Segment] = dataclasses.field(default_factory=list)
+
   def duration_secs(self) -> float:
+    """Returns the time spent, not counting cached LLM calls."""
     return (
-        sum([r.duration_secs for r in self.llm_calls]) + self.dc_duration_secs
+        sum([r.duration_secs for r in self.llm_calls if not r.cached])
+        + self.dc_duration_secs
     )
 
+  def avoided_llm_secs(self) -> float:
+    """Returns the LLM time saved by cache hits."""
+    return sum([r.duration_secs for r in self.llm_calls if r.cached])
+
   def answer(self, include_aux: bool = True) -> str:
     """Returns a string representation of the response."""
 
@@ -160,6 +201,9 @@ class FlowResponse:
         lines.append(dbg)
     lines.append(f'\n\n## DC Duration {self.dc_duration_secs} ##')
     lines.append(f'\n\n## Total Duration {self.duration_secs()} ##')
+    avoided = self.avoided_llm_secs()
+    if avoided:
+      lines.append(f'\n\n## Avoided LLM Duration {avoided} ##')
 
     return '\n'.join(lines)
 
@@ -172,9 +216,153 @@ class LLM(Protocol):
   def query(self, prompt: str) -> LLMCall:
     ...
 
+  def query_stream(self, prompt: str) -> Iterator[str | LLMCall]:
+    """Yields response text chunks, and finally the complete LLMCall.
+
+    This default is for backends without native streaming, and yields the
+    whole response as a single chunk.
+    """
+    resp = self.query(prompt)
+    yield resp.response
+    if resp.ttft_secs is None:
+      resp = dataclasses.replace(resp, ttft_secs=resp.duration_secs)
+    yield resp
+
+  async def aquery(self, prompt: str) -> LLMCall:
+    """Async version of `query`.
+
+    This default is for backends without an async client, and runs `query`
+    in the default executor.
+    """
+    return await asyncio.to_thread(self.query, prompt)
+
+
+def query_stream(llm: LLM, prompt: str) -> Iterator[str | LLMCall]:
+  """Calls `llm.query_stream`, falling back for LLMs that lack it."""
+  if hasattr(llm, 'query_stream'):
+    return llm.query_stream(prompt)
+  return LLM.query_stream(llm, prompt)
+
+
+async def aquery(llm: LLM, prompt: str) -> LLMCall:
+  """Calls `llm.aquery`, falling back for LLMs that lack it."""
+  if hasattr(llm, 'aquery'):
+    return await llm.aquery(prompt)
+  return await LLM.aquery(llm, prompt)
+
+
+@dataclasses.dataclass
+class FlowState:
+  """The state of one query as it moves through the stages of a Flow."""
+
+  query: str
+  llm_calls: list[LLMCall] = dataclasses.field(default_factory=list)
+  q2resp: dict[str, DataCommonsCall] = dataclasses.field(default_factory=dict)
+  dc_duration_secs: float = 0.0
+
+  # Set by the last stage, or by an earlier one that ends the flow early.
+  response: FlowResponse | None = None
+
+
+# A named step of a Flow that updates the FlowState in place.
+Stage = tuple[str, Callable[[FlowState], None]]
+AsyncStage = tuple[str, Callable[[FlowState], Awaitable[None]]]
+
 
 class Flow(Protocol):
   """A Flow integrates LLMs with DC in a certain way."""
 
   def query(self, query: str) -> FlowResponse:
     ...
+
+  def new_state(self, query: str) -> FlowState:
+    return FlowState(query=query)
+
+  def stages(self) -> list[Stage]:
+    """Returns the stages that `query` runs, in order.
+
+    Flows that split their work into stages let batch runners overlap
+    different stages of different queries.
+    """
+    def _query(state: FlowState) -> None:
+      state.response = self.query(state.query)
+
+    return [('answer', _query)]
+
+  async def aquery(self, query: str) -> FlowResponse:
+    ...
+
+
+_FLOW_SECONDS = metrics.histogram(
+    'data_gemma_flow_seconds', 'End-to-end latency of flow queries.', ('flow',)
+)
+_STAGE_SECONDS = metrics.histogram(
+    'data_gemma_stage_seconds', 'Latency of flow stages.', ('flow', 'stage')
+)
+_STAGE_ERRORS = metrics.counter(
+    'data_gemma_stage_errors_total',
+    'Flow stages that raised.',
+    ('flow', 'stage'),
+)
+
+
+def run_stages(flow: Flow, query: str) -> FlowResponse:
+  """Runs the stages of flow for query, stopping once there is a response."""
+  flow_name = type(flow).__name__
+  start = time.time()
+  try:
+    with tracing.span('flow', flow=flow_name, query=query):
+      state = flow.new_state(query)
+      for name, stage in flow.stages():
+        run_stage(flow_name, name, stage, state)
+        if state.response is not None:
+          return state.response
+      return FlowResponse(llm_calls=state.llm_calls)
+  finally:
+    _FLOW_SECONDS.labels(flow_name).observe(time.time() - start)
+
+
+async def arun_stages(
+    flow: Flow, query: str, stages: list[AsyncStage]
+) -> FlowResponse:
+  """Async version of `run_stages`."""
+  flow_name = type(flow).__name__
+  start = time.time()
+  try:
+    with tracing.span('flow', flow=flow_name, query=query):
+      state = flow.new_state(query)
+      for name, stage in stages:
+        stage_start = time.time()
+        try:
+          with tracing.span(f'stage.{name}'):
+            await stage(state)
+        except Exception:
+          _STAGE_ERRORS.labels(flow_name, name).inc()
+          raise
+        finally:
+          _STAGE_SECONDS.labels(flow_name, name).observe(
+              time.time() - stage_start
+          )
+        if state.response is not None:
+          return state.response
+      return FlowResponse(llm_calls=state.llm_calls)
+  finally:
+    _FLOW_SECONDS.labels(flow_name).observe(time.time() - start)
+
+
+def run_stage(
+    flow_name: str,
+    name: str,
+    stage: Callable[[FlowState], None],
+    state: FlowState,
+) -> None:
+  """Runs a single stage, tracing it and recording its latency and errors."""
+  start = time.time()
+  try:
+    with tracing.span(f'stage.{name}'):
+      stage(state)
+  except Exception:
+    _STAGE_ERRORS.labels(flow_name, name).inc()
+    raise
+  finally:
+    _STAGE_SECONDS.labels(flow_name, name).observe(time.time() - start)
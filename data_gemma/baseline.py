@@ -36,10 +36,17 @@ class BaselineFlow(base.Flow):
       prompt2: str = '',
   ) -> base.FlowResponse:
     self.options.vlog('... [DEFAULT] Calling BASE model')
-    resp = self.llm.query(query)
-    return base.FlowResponse(
-        main_text=resp.response,
-        llm_calls=[resp],
-        dc_duration_secs=0,
-        dc_calls=[],
-    )
+    return _response(self.llm.query(query))
+
+  async def aquery(self, query: str) -> base.FlowResponse:
+    self.options.vlog('... [DEFAULT] Calling BASE model')
+    return _response(await base.aquery(self.llm, query))
+
+
+def _response(resp: base.LLMCall) -> base.FlowResponse:
+  return base.FlowResponse(
+      main_text=resp.response,
+      llm_calls=[resp],
+      dc_duration_secs=0,
+      dc_calls=[],
+  )
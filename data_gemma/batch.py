@@ -0,0 +1,203 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pipelined batch execution of Flows."""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+from data_gemma import base
+from data_gemma import metrics
+from data_gemma import tracing
+
+# Default worker threads per stage.
+_NUM_WORKERS = 4
+
+_STOP = object()
+
+# How often a wait for a full stage checks whether the batch was cancelled.
+_CANCEL_POLL_SECS = 0.1
+
+# The same metric as `run_stages` records to.
+_FLOW_SECONDS = metrics.histogram(
+    'data_gemma_flow_seconds', 'End-to-end latency of flow queries.', ('flow',)
+)
+_QUEUE_DEPTH = metrics.gauge(
+    'data_gemma_batch_queue_depth',
+    'Queries waiting for a run_batch stage.',
+    ('flow', 'stage'),
+)
+
+
+def run_batch(
+    flow: base.Flow,
+    queries: list[str],
+    num_workers: dict[str, int] | None = None,
+    max_in_flight: int = 0,
+    ordered: bool = True,
+) -> Iterator[tuple[int, base.FlowResponse]]:
+  """Runs flow over queries, overlapping the stages of different queries.
+
+  Each stage of the flow (e.g., question generation, DC lookup, validation
+  and answer) gets its own queue and worker threads, so that, say, the LLM
+  answers one query while DC is fetching data for the next.
+
+  Args:
+    flow: The flow to run.
+    queries: The queries to run.
+    num_workers: Worker threads per stage name; stages not listed get
+      `_NUM_WORKERS`.
+    max_in_flight: Max queries waiting in front of each stage, or 0 for twice
+      the stage's workers.
+    ordered: Whether to yield in input order, or as soon as each is done.
+
+  Yields:
+    (index into queries, FlowResponse) pairs.
+  """
+  num_workers = num_workers or {}
+  stages = [
+      _StageRunner(type(flow).__name__, name, stage,
+                   num_workers.get(name, _NUM_WORKERS), max_in_flight)
+      for name, stage in flow.stages()
+  ]
+  done: queue.Queue[tuple[int, base.FlowResponse]] = queue.Queue()
+  # Set when the caller stops iterating, so that queued work is dropped.
+  cancelled = threading.Event()
+  for i, stage in enumerate(stages):
+    stage.start(stages[i + 1] if i + 1 < len(stages) else None, done,
+                cancelled)
+
+  def _feed() -> None:
+    for idx, query in enumerate(queries):
+      if cancelled.is_set():
+        return
+      # The parent of the query's stage spans, which run on other threads.
+      root = tracing.start_span(
+          'flow', flow=type(flow).__name__, query=query, batch_idx=idx
+      )
+      item = (idx, flow.new_state(query), root, time.time())
+      if not stages[0].put(item):
+        root.end()
+        return
+
+  threading.Thread(target=_feed, name='run_batch-feed', daemon=True).start()
+
+  try:
+    pending: dict[int, base.FlowResponse] = {}
+    next_idx = 0
+    for _ in range(len(queries)):
+      idx, resp = done.get()
+      if not ordered:
+        yield idx, resp
+        continue
+      pending[idx] = resp
+      while next_idx in pending:
+        yield next_idx, pending.pop(next_idx)
+        next_idx += 1
+  finally:
+    cancelled.set()
+    for stage in stages:
+      stage.stop()
+
+
+class _StageRunner:
+  """Worker threads for one stage, fed by an unbounded queue.
+
+  A semaphore, rather than the queue size, bounds the queries waiting for
+  the stage, so that stopping never blocks.  Once the batch is cancelled,
+  queued queries are dropped, and waits for a slot give up.
+  """
+
+  def __init__(
+      self,
+      flow_name: str,
+      name: str,
+      stage: Callable[[base.FlowState], None],
+      num_workers: int,
+      max_in_flight: int,
+  ):
+    self.flow_name = flow_name
+    self.name = name
+    self.stage = stage
+    self.num_workers = num_workers
+    self._queue: queue.Queue[Any] = queue.Queue()
+    self._slots = threading.Semaphore(max_in_flight or 2 * num_workers)
+    self._depth = _QUEUE_DEPTH.labels(flow_name, name)
+    self._cancelled = threading.Event()
+
+  def start(
+      self,
+      next_stage: '_StageRunner | None',
+      done: queue.Queue[tuple[int, base.FlowResponse]],
+      cancelled: threading.Event,
+  ) -> None:
+    self._cancelled = cancelled
+    for _ in range(self.num_workers):
+      threading.Thread(
+          target=self._work,
+          args=(next_stage, done),
+          name=f'run_batch-{self.name}',
+          daemon=True,
+      ).start()
+
+  def put(self, item: tuple[int, base.FlowState, Any, float]) -> bool:
+    """Queues item, returning False if the batch was cancelled instead."""
+    while not self._slots.acquire(timeout=_CANCEL_POLL_SECS):
+      if self._cancelled.is_set():
+        return False
+    if self._cancelled.is_set():
+      self._slots.release()
+      return False
+    self._depth.inc()
+    self._queue.put(item)
+    return True
+
+  def stop(self) -> None:
+    for _ in range(self.num_workers):
+      self._queue.put(_STOP)
+
+  def _work(
+      self,
+      next_stage: '_StageRunner | None',
+      done: queue.Queue[tuple[int, base.FlowResponse]],
+  ) -> None:
+    while True:
+      item = self._queue.get()
+      if item is _STOP:
+        return
+      self._slots.release()
+      self._depth.dec()
+      idx, state, root, start = item
+      if self._cancelled.is_set():
+        root.set(cancelled=True)
+        root.end()
+        continue
+      try:
+        with tracing.use(root):
+          base.run_stage(self.flow_name, self.name, self.stage, state)
+      except Exception:  # pylint: disable=broad-exception-caught
+        logging.exception('Stage %s failed for "%s"', self.name, state.query)
+        state.response = base.FlowResponse(llm_calls=state.llm_calls)
+      if state.response is None and next_stage:
+        if not next_stage.put(item):
+          root.set(cancelled=True)
+          root.end()
+        continue
+      root.end()
+      _FLOW_SECONDS.labels(self.flow_name).observe(time.time() - start)
+      done.put(
+          (idx, state.response or base.FlowResponse(llm_calls=state.llm_calls))
+      )
@@ -0,0 +1,358 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Response caches."""
+
+import collections
+import dataclasses
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Iterator
+
+from data_gemma import base
+from data_gemma import tracing
+
+# Positive responses are valid for a day.
+_DEFAULT_TTL_SECS = 24 * 60 * 60
+# "No chart" responses are retried much sooner.
+_DEFAULT_NEGATIVE_TTL_SECS = 10 * 60
+
+_DEFAULT_MAX_MEMORY_ENTRIES = 10000
+_DEFAULT_MAX_DISK_ENTRIES = 1000000
+
+# LLM responses are larger, so keep fewer in memory.
+_DEFAULT_LLM_TTL_SECS = 7 * 24 * 60 * 60
+_DEFAULT_LLM_MAX_MEMORY_ENTRIES = 1000
+_DEFAULT_LLM_MAX_DISK_ENTRIES = 100000
+
+
+def normalize_query(query: str) -> str:
+  """Normalizes a query so trivially different strings share an entry."""
+  return re.sub(r'\s+', ' ', query.strip().lower())
+
+
+class LRU:
+  """A thread-safe in-memory LRU with per-entry expiry."""
+
+  def __init__(self, max_entries: int):
+    self.max_entries = max_entries
+    self._entries: collections.OrderedDict[str, tuple[float, Any]] = (
+        collections.OrderedDict()
+    )
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> Any | None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      expiry, value = entry
+      if expiry < time.time():
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return value
+
+  def put(self, key: str, value: Any, ttl_secs: float) -> None:
+    with self._lock:
+      self._entries[key] = (time.time() + ttl_secs, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+
+class SQLiteStore:
+  """A size-bounded, TTL'd key-value store on a SQLite file.
+
+  The file can be shared by several processes on the same host.
+  """
+
+  def __init__(self, path: str, max_entries: int):
+    self.path = path
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    with self._lock, self._conn:
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute(
+          'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT,'
+          ' expiry REAL, accessed REAL)'
+      )
+      self._conn.execute(
+          'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)'
+      )
+    self._puts = 0
+
+  def get(self, key: str) -> str | None:
+    now = time.time()
+    with self._lock:
+      row = self._conn.execute(
+          'SELECT value, expiry FROM cache WHERE key = ?', (key,)
+      ).fetchone()
+      if row is None:
+        return None
+      with self._conn:
+        if row[1] < now:
+          self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+          return None
+        self._conn.execute(
+            'UPDATE cache SET accessed = ? WHERE key = ?', (now, key)
+        )
+      return row[0]
+
+  def put(self, key: str, value: str, ttl_secs: float) -> None:
+    now = time.time()
+    with self._lock, self._conn:
+      self._conn.execute(
+          'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+          (key, value, now + ttl_secs, now),
+      )
+      self._puts += 1
+      # Counting rows is not free, so only enforce the bound periodically.
+      if self._puts % 100 == 0:
+        self._evict(now)
+
+  def _evict(self, now: float) -> None:
+    self._conn.execute('DELETE FROM cache WHERE expiry < ?', (now,))
+    (count,) = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()
+    if count > self.max_entries:
+      self._conn.execute(
+          'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY'
+          ' accessed LIMIT ?)',
+          (count - self.max_entries,),
+      )
+
+  def clear(self) -> None:
+    with self._lock, self._conn:
+      self._conn.execute('DELETE FROM cache')
+
+  def close(self) -> None:
+    with self._lock:
+      self._conn.close()
+
+
+class DCCache:
+  """Two-tier cache of Data Commons responses.
+
+  An in-process LRU sits in front of an optional SQLite file.  Entries are
+  keyed by env, mode and normalized query.  Responses without data ("no
+  chart") are cached with a shorter TTL.
+  """
+
+  def __init__(
+      self,
+      path: str = '',
+      ttl_secs: float = _DEFAULT_TTL_SECS,
+      negative_ttl_secs: float = _DEFAULT_NEGATIVE_TTL_SECS,
+      max_memory_entries: int = _DEFAULT_MAX_MEMORY_ENTRIES,
+      max_disk_entries: int = _DEFAULT_MAX_DISK_ENTRIES,
+  ):
+    self.ttl_secs = ttl_secs
+    self.negative_ttl_secs = negative_ttl_secs
+    self.memory = LRU(max_memory_entries)
+    self.disk = SQLiteStore(path, max_disk_entries) if path else None
+
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+  def get(
+      self, env: str, mode: str, query: str
+  ) -> base.DataCommonsCall | None:
+    """Returns a fresh copy of the cached response, if any."""
+    key = cache_key(env, mode, query)
+    fields = self.memory.get(key)
+    from_disk = False
+    if fields is None and self.disk:
+      value = self.disk.get(key)
+      if value is not None:
+        fields = json.loads(value)
+        from_disk = True
+        # The remaining TTL is unknown here, so use the short one.
+        self.memory.put(key, fields, self.negative_ttl_secs)
+    with self._lock:
+      if fields is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      if from_disk:
+        self.disk_hits += 1
+    resp = base.DataCommonsCall(**fields)
+    resp.query = query
+    return resp
+
+  def put(
+      self, env: str, mode: str, query: str, resp: base.DataCommonsCall
+  ) -> None:
+    key = cache_key(env, mode, query)
+    fields = dataclasses.asdict(resp)
+    fields['id'] = 0
+    ttl = self.ttl_secs if resp.title else self.negative_ttl_secs
+    self.memory.put(key, fields, ttl)
+    if self.disk:
+      self.disk.put(key, json.dumps(fields), ttl)
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'disk_hits': self.disk_hits,
+          'misses': self.misses,
+          'memory_entries': len(self.memory),
+      }
+
+  def clear(self) -> None:
+    self.memory.clear()
+    if self.disk:
+      self.disk.clear()
+
+  def close(self) -> None:
+    if self.disk:
+      self.disk.close()
+
+
+def cache_key(env: str, mode: str, query: str) -> str:
+  return f'{env}|{mode}|{normalize_query(query)}'
+
+
+class CachedLLM(base.LLM):
+  """Wraps an LLM with a content-addressed response cache.
+
+  Entries are keyed by a hash of the prompt, the model id and generation
+  settings, so a single file can be shared by different models.  The model
+  id defaults to the API model name, or the `name_or_path` of an HF model;
+  it must be passed for HF models without one.  Only
+  successful responses are cached.  Cache hits come back with `cached` set
+  and the duration of the original call.
+  """
+
+  def __init__(
+      self,
+      llm: base.LLM,
+      path: str = '',
+      model_id: str = '',
+      settings: dict[str, Any] | None = None,
+      ttl_secs: float = _DEFAULT_LLM_TTL_SECS,
+      max_memory_entries: int = _DEFAULT_LLM_MAX_MEMORY_ENTRIES,
+      max_disk_entries: int = _DEFAULT_LLM_MAX_DISK_ENTRIES,
+  ):
+    self.llm = llm
+    self.model_id = model_id or _model_id(llm)
+    # Generation settings that affect the response, e.g., temperature.
+    self.settings = settings or {}
+    self.ttl_secs = ttl_secs
+    self.memory = LRU(max_memory_entries)
+    self.disk = SQLiteStore(path, max_disk_entries) if path else None
+
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  @tracing.llm_call
+  def query(self, prompt: str) -> base.LLMCall:
+    key = self._key(prompt)
+    resp = self._get(key, prompt)
+    if resp:
+      return resp
+    resp = self.llm.query(prompt)
+    self._put(key, resp)
+    return resp
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    key = self._key(prompt)
+    resp = self._get(key, prompt)
+    if resp:
+      yield resp.response
+      yield resp
+      return
+    for chunk in base.query_stream(self.llm, prompt):
+      if isinstance(chunk, base.LLMCall):
+        self._put(key, chunk)
+      yield chunk
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'memory_entries': len(self.memory),
+      }
+
+  def close(self) -> None:
+    if self.disk:
+      self.disk.close()
+
+  def _key(self, prompt: str) -> str:
+    content = json.dumps(
+        [self.model_id, self.settings, prompt], sort_keys=True
+    )
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+  def _get(self, key: str, prompt: str) -> base.LLMCall | None:
+    fields = self.memory.get(key)
+    if fields is None and self.disk:
+      value = self.disk.get(key)
+      if value is not None:
+        fields = json.loads(value)
+        self.memory.put(key, fields, self.ttl_secs)
+    with self._lock:
+      if fields is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+    return base.LLMCall(prompt=prompt, cached=True, **fields)
+
+  def _put(self, key: str, resp: base.LLMCall) -> None:
+    if resp.error or not resp.response:
+      return
+    fields = {
+        'response': resp.response,
+        'duration_secs': resp.duration_secs,
+    }
+    self.memory.put(key, fields, self.ttl_secs)
+    if self.disk:
+      self.disk.put(key, json.dumps(fields), self.ttl_secs)
+
+
+def _model_id(llm: base.LLM) -> str:
+  """Returns the id of the model behind llm, for cache keys."""
+  model = getattr(llm, 'model', None)
+  pipeline = getattr(llm, 'pipeline', None)
+  if model is None and pipeline is not None:
+    model = getattr(pipeline, 'model', None)
+  if model is None:
+    return type(llm).__name__
+  if isinstance(model, str):
+    return model
+  # A HuggingFace model, e.g., of HFBasic or HFPipeline.
+  name = getattr(model, 'name_or_path', '') or getattr(
+      getattr(model, 'config', None), 'name_or_path', ''
+  )
+  if not name:
+    raise ValueError(
+        f'Cannot tell the model of {type(llm).__name__}; pass model_id'
+    )
+  return f'{type(llm).__name__}:{name}'
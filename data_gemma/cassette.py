@@ -0,0 +1,288 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record and replay of LLM and DC traffic, for deterministic benchmarks.
+
+Record a real run:
+
+  tape = cassette.Cassette('run.json.gz', mode=cassette.RECORD)
+  flow = rig.RIGFlow(
+      llm=cassette.CassetteLLM(tape, llm),
+      data_fetcher=cassette.CassetteDataCommons(tape, api_key=key),
+  )
+  ...
+  tape.save()
+
+Then replay it offline, with the same flow and queries:
+
+  tape = cassette.Cassette('run.json.gz', realtime=True)
+  flow = rig.RIGFlow(
+      llm=cassette.CassetteLLM(tape),
+      data_fetcher=cassette.CassetteDataCommons(tape),
+  )
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Iterator
+
+from data_gemma import base
+from data_gemma import datacommons
+from data_gemma import tracing
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+_VERSION = 1
+
+# API keys are never written to a cassette.
+_KEY_PARAM = re.compile(r'&key=[^&]*')
+# DC calls are keyed by their query parameters, so a run recorded against
+# one server (e.g., `DataCommons.base_url`) can be replayed with another.
+_QUERY_PARAMS = re.compile(r'^[^?]*\?')
+
+
+class Cassette:
+  """LLM prompt/response and DC URL/JSON pairs, saved as gzipped JSON.
+
+  A prompt or URL seen several times keeps each of its responses, which are
+  replayed in order, wrapping around.  With `realtime`, replay sleeps for
+  the recorded latency of each response; otherwise it is instant, and LLM
+  calls report zero duration.
+  """
+
+  def __init__(self, path: str, mode: str = REPLAY, realtime: bool = False):
+    if mode not in (RECORD, REPLAY):
+      raise ValueError(f'Unknown cassette mode: {mode}')
+    self.path = path
+    self.mode = mode
+    self.realtime = realtime
+    # (LLM name, prompt) -> [LLMCall fields].
+    self._llm: dict[tuple[str, str], list[dict[str, Any]]] = {}
+    # URL query parameters -> [(JSON response, seconds)].
+    self._dc: dict[str, list[tuple[Any, float]]] = {}
+    self._cursors: dict[Any, int] = {}
+    self._lock = threading.Lock()
+    self.misses = 0
+    if mode == REPLAY:
+      self._load()
+
+  @property
+  def recording(self) -> bool:
+    return self.mode == RECORD
+
+  def record_llm(self, name: str, resp: base.LLMCall) -> None:
+    fields = {
+        'response': resp.response,
+        'duration_secs': resp.duration_secs,
+        'error': resp.error,
+        'ttft_secs': resp.ttft_secs,
+    }
+    with self._lock:
+      self._llm.setdefault((name, resp.prompt), []).append(fields)
+
+  def replay_llm(self, name: str, prompt: str) -> tuple[base.LLMCall, float]:
+    """Returns the next recorded call for prompt, and its latency."""
+    fields = self._next(self._llm, (name, prompt))
+    if fields is None:
+      logging.warning('Prompt not in cassette: "%s..."', prompt[:50])
+      err = f'Prompt not in cassette {self.path}'
+      return (
+          base.LLMCall(
+              prompt=prompt, response='', duration_secs=0.0, error=err
+          ),
+          0.0,
+      )
+    secs = fields['duration_secs']
+    if not self.realtime:
+      fields = dict(fields, duration_secs=0.0, ttft_secs=None)
+    return base.LLMCall(prompt=prompt, **fields), secs
+
+  def record_dc(self, url: str, resp: Any, secs: float) -> None:
+    with self._lock:
+      self._dc.setdefault(_url_key(url), []).append((resp, round(secs, 3)))
+
+  def replay_dc(self, url: str) -> tuple[Any, float]:
+    """Returns the next recorded response for url, and its latency.
+
+    Raises:
+      KeyError: if url was not recorded, which fails the DC call.
+    """
+    key = _url_key(url)
+    entry = self._next(self._dc, key)
+    if entry is None:
+      raise KeyError(f'URL not in cassette {self.path}: {key}')
+    return entry
+
+  def delay(self, secs: float) -> None:
+    if self.realtime and secs > 0:
+      time.sleep(secs)
+
+  async def adelay(self, secs: float) -> None:
+    if self.realtime and secs > 0:
+      await asyncio.sleep(secs)
+
+  def save(self) -> None:
+    """Writes the recorded calls to `path`."""
+    with self._lock:
+      data = {
+          'version': _VERSION,
+          'llm': [
+              {'name': name, 'prompt': prompt, 'calls': calls}
+              for (name, prompt), calls in self._llm.items()
+          ],
+          'dc': [
+              {'params': params, 'responses': responses}
+              for params, responses in self._dc.items()
+          ],
+      }
+    tmp = f'{self.path}.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+      json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, self.path)
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+          'llm_prompts': len(self._llm),
+          'llm_calls': sum(len(c) for c in self._llm.values()),
+          'dc_queries': len(self._dc),
+          'dc_calls': sum(len(r) for r in self._dc.values()),
+          'misses': self.misses,
+      }
+
+  def __enter__(self) -> 'Cassette':
+    return self
+
+  def __exit__(self, *args) -> None:
+    if self.recording:
+      self.save()
+
+  def _load(self) -> None:
+    with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+      data = json.load(f)
+    if data.get('version') != _VERSION:
+      raise ValueError(f'Unsupported cassette version in {self.path}')
+    for e in data['llm']:
+      self._llm[(e['name'], e['prompt'])] = e['calls']
+    for e in data['dc']:
+      self._dc[e['params']] = [tuple(r) for r in e['responses']]
+
+  def _next(self, entries: dict[Any, list[Any]], key: Any) -> Any | None:
+    with self._lock:
+      values = entries.get(key)
+      if not values:
+        self.misses += 1
+        return None
+      # LLM keys are tuples and DC keys strings, so they can share cursors.
+      i = self._cursors.get(key, 0)
+      self._cursors[key] = i + 1
+      return values[i % len(values)]
+
+
+class CassetteLLM(base.LLM):
+  """Records the calls of an LLM to a cassette, or replays them.
+
+  Flows with several LLMs should give each a distinct `name`, in case they
+  are sent the same prompt.
+  """
+
+  def __init__(
+      self, cassette: Cassette, llm: base.LLM | None = None, name: str = ''
+  ):
+    if cassette.recording and llm is None:
+      raise ValueError('Recording needs an LLM to record')
+    self.cassette = cassette
+    self.llm = llm
+    self.name = name
+
+  @tracing.llm_call
+  def query(self, prompt: str) -> base.LLMCall:
+    if self.cassette.recording:
+      resp = self.llm.query(prompt)
+      self.cassette.record_llm(self.name, resp)
+      return resp
+    resp, secs = self.cassette.replay_llm(self.name, prompt)
+    self.cassette.delay(secs)
+    return resp
+
+  @tracing.llm_call
+  async def aquery(self, prompt: str) -> base.LLMCall:
+    if self.cassette.recording:
+      resp = await base.aquery(self.llm, prompt)
+      self.cassette.record_llm(self.name, resp)
+      return resp
+    resp, secs = self.cassette.replay_llm(self.name, prompt)
+    await self.cassette.adelay(secs)
+    return resp
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    if self.cassette.recording:
+      for chunk in base.query_stream(self.llm, prompt):
+        if isinstance(chunk, base.LLMCall):
+          self.cassette.record_llm(self.name, chunk)
+        yield chunk
+      return
+    resp, secs = self.cassette.replay_llm(self.name, prompt)
+    if resp.ttft_secs is not None:
+      self.cassette.delay(resp.ttft_secs)
+      secs -= resp.ttft_secs
+    if resp.response:
+      yield resp.response
+    self.cassette.delay(secs)
+    yield resp
+
+
+class CassetteDataCommons(datacommons.DataCommons):
+  """Records the DC API responses to a cassette, or replays them.
+
+  Only the HTTP calls are replaced, so parsing, caching and coalescing run
+  as usual.
+  """
+
+  def __init__(self, cassette: Cassette, api_key: str = '', **kwargs: Any):
+    super().__init__(api_key, **kwargs)
+    self.cassette = cassette
+
+  def _call_api(self, query: str, extra_params: str) -> Any:
+    url = self._url(query, extra_params)
+    if self.cassette.recording:
+      start = time.time()
+      resp = super()._call_api(query, extra_params)
+      self.cassette.record_dc(url, resp, time.time() - start)
+      return resp
+    resp, secs = self.cassette.replay_dc(url)
+    self.cassette.delay(secs)
+    return resp
+
+  async def _acall_api(self, query: str, extra_params: str) -> Any:
+    url = self._url(query, extra_params)
+    if self.cassette.recording:
+      start = time.time()
+      resp = await super()._acall_api(query, extra_params)
+      self.cassette.record_dc(url, resp, time.time() - start)
+      return resp
+    resp, secs = self.cassette.replay_dc(url)
+    await self.cassette.adelay(secs)
+    return resp
+
+
+def _url_key(url: str) -> str:
+  return _KEY_PARAM.sub('', _QUERY_PARAMS.sub('', url, count=1))
@@ -0,0 +1,98 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Adaptive concurrency control."""
+
+import threading
+import time
+
+from data_gemma import utils
+
+# Latency is "rising" once it exceeds this multiple of the recent p10.
+_LATENCY_TOLERANCE = 2.0
+# Latencies needed before latency (rather than errors) can shrink the limit.
+_MIN_SAMPLES = 20
+
+
+class AIMDLimiter:
+  """Limits in-flight requests with additive-increase/multiplicative-decrease.
+
+  Each success that comes back with flat latency grows the limit by about
+  one per round trip.  A throttle, timeout or latency spike cuts it by
+  `decrease_factor`, at most once per round trip so that a burst of
+  failures from the same overload only counts once.
+  """
+
+  def __init__(
+      self,
+      initial_limit: int,
+      min_limit: int = 1,
+      max_limit: int = 64,
+      decrease_factor: float = 0.5,
+      latency_tolerance: float = _LATENCY_TOLERANCE,
+  ):
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.decrease_factor = decrease_factor
+    self.latency_tolerance = latency_tolerance
+    self.latencies = utils.LatencyWindow()
+
+    self._limit = float(min(max(initial_limit, min_limit), max_limit))
+    self._in_flight = 0
+    self._last_decrease = 0.0
+    self._cond = threading.Condition()
+
+  @property
+  def limit(self) -> int:
+    return int(self._limit)
+
+  def acquire(self) -> None:
+    with self._cond:
+      while self._in_flight >= int(self._limit):
+        self._cond.wait()
+      self._in_flight += 1
+
+  def release(self, latency_secs: float, ok: bool) -> None:
+    """Releases a slot and adjusts the limit by the outcome of its request."""
+    if ok:
+      self.latencies.add(latency_secs)
+    with self._cond:
+      self._in_flight -= 1
+      if ok and not self._latency_rising(latency_secs):
+        self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+      else:
+        self._decrease()
+      self._cond.notify_all()
+
+  def stats(self) -> dict[str, float]:
+    with self._cond:
+      limit, in_flight = self.limit, self._in_flight
+    return {
+        'limit': limit,
+        'in_flight': in_flight,
+        'p50_secs': self.latencies.percentile(50),
+        'p95_secs': self.latencies.percentile(95),
+        'p99_secs': self.latencies.percentile(99),
+    }
+
+  def _latency_rising(self, latency_secs: float) -> bool:
+    if len(self.latencies) < _MIN_SAMPLES:
+      return False
+    return latency_secs > self.latency_tolerance * self.latencies.percentile(10)
+
+  def _decrease(self) -> None:
+    now = time.time()
+    if now - self._last_decrease < self.latencies.percentile(50):
+      return
+    self._last_decrease = now
+    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
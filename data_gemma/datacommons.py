@@ -13,14 +13,34 @@
 # limitations under the License.
 """Data Commons."""
 
+import asyncio
 import concurrent.futures
 import csv
+import dataclasses
 import io
-from typing import Any, Callable
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable
+import weakref
 
 import requests
+from requests import adapters
+from urllib3.util import retry
+
+try:
+  import aiohttp  # pylint: disable=g-import-not-at-top
+except ImportError:
+  aiohttp = None
 
 from data_gemma import base
+from data_gemma import cache as dc_cache
+from data_gemma import concurrency
+from data_gemma import metrics
+from data_gemma import singleflight
+from data_gemma import tracing
 from data_gemma import utils
 
 _BASE_URL = 'https://{env}.datacommons.org/nodejs/query'
@@ -34,6 +54,78 @@ _POINT_PARAMS = f'allCharts=1&mode={_POINT_MODE}&idx=base_uae_mem'
 # Allow topics, use lower threshold (0.7).
 _TABLE_PARAMS = f'mode={_TABLE_MODE}&client=table&idx=base_uae_mem'
 
+# Max in-flight async DC requests per event loop, shared by all instances.
+_ASYNC_CONCURRENCY = 64
+_async_semaphores: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, asyncio.Semaphore
+] = weakref.WeakKeyDictionary()
+_async_semaphores_lock = threading.Lock()
+
+_FETCHES = metrics.counter(
+    'data_gemma_dc_fetches_total',
+    'DC lookups by mode and source (cache, network or coalesced).',
+    ('mode', 'source'),
+)
+_HTTP_REQUESTS = metrics.counter(
+    'data_gemma_dc_http_requests_total',
+    'DC HTTP attempts by status code, or "error" for connection failures.',
+    ('status',),
+)
+_HTTP_SECONDS = metrics.histogram(
+    'data_gemma_dc_http_seconds', 'Latency of DC HTTP attempts.'
+)
+_HTTP_IN_FLIGHT = metrics.gauge(
+    'data_gemma_dc_http_in_flight', 'DC HTTP requests in flight.'
+)
+_HEDGED_REQUESTS = metrics.counter(
+    'data_gemma_dc_hedged_requests_total', 'Hedge DC requests sent.'
+)
+
+# Retries for failures to connect (DNS, refused, TLS), which are always safe
+# to retry.
+_CONNECT_RETRIES = 2
+
+_TIMEOUT_SECS = 30
+_MAX_RETRIES = 3
+_BACKOFF_SECS = 0.5
+_MAX_BACKOFF_SECS = 10
+# Throttled or transient server-side failures.
+_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Stripped from errors, which may quote the request URL.
+_KEY_PARAM = re.compile(r'&key=[^&]*')
+
+# A hedge is sent once a request is slower than this percentile of recent
+# latencies, and only after enough latencies have been seen.
+_HEDGE_PERCENTILE = 95
+_HEDGE_MIN_SAMPLES = 20
+
+# Coalesces identical in-flight requests across all instances.
+_SINGLE_FLIGHT = singleflight.SingleFlight()
+
+
+def coalesced_requests() -> int:
+  """Returns how many DC requests were served by another in-flight request."""
+  return _SINGLE_FLIGHT.coalesced
+
+
+def set_async_concurrency(limit: int) -> None:
+  """Sets the process-wide cap on in-flight async DC requests.
+
+  Only affects event loops that have not made a DC request yet.
+  """
+  global _ASYNC_CONCURRENCY
+  _ASYNC_CONCURRENCY = limit
+
+
+def _async_semaphore() -> asyncio.Semaphore:
+  loop = asyncio.get_running_loop()
+  with _async_semaphores_lock:
+    sem = _async_semaphores.get(loop)
+    if sem is None:
+      sem = asyncio.Semaphore(_ASYNC_CONCURRENCY)
+      _async_semaphores[loop] = sem
+    return sem
+
 
 class DataCommons:
   """Data Commons."""
@@ -45,116 +137,83 @@ class DataCommons:
       num_threads: int = 1,
       env: str = 'nl',
       session: requests.Session | None = None,
+      cache: dc_cache.DCCache | None = None,
+      async_session: Any = None,
+      coalesce: bool = True,
+      timeout_secs: float = _TIMEOUT_SECS,
+      max_retries: int = _MAX_RETRIES,
+      backoff_secs: float = _BACKOFF_SECS,
+      hedge: bool = False,
+      adaptive_concurrency: bool = False,
+      max_threads: int = 0,
+      base_url: str = _BASE_URL,
   ):
     self.options = base.Options(verbose=verbose)
     self.num_threads = num_threads
+    # With adaptive concurrency, `num_threads` is only the starting limit and
+    # the limiter may grow up to `max_threads` parallel requests.
+    self.limiter: concurrency.AIMDLimiter | None = None
+    if adaptive_concurrency:
+      max_threads = max(max_threads or 4 * num_threads, num_threads)
+      self.limiter = concurrency.AIMDLimiter(
+          initial_limit=num_threads, max_limit=max_threads
+      )
+    self.max_threads = max(max_threads, num_threads)
     self.env = env
+    # The query endpoint, with an optional `{env}` placeholder.  Point it at
+    # e.g. `benchmarks/fake_dc_server.py` for load tests.
+    self.base_url = base_url
     self.api_key = api_key
+    self._owns_session = session is None
     if not session:
-      session = requests.Session()
+      session = _new_session(self.max_threads)
     self.session = session
+    self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+    self._executor_lock = threading.Lock()
+    self.cache = cache
+    # An `aiohttp.ClientSession`, created lazily unless one is passed in.
+    self.async_session = async_session
+    self._owns_async_session = async_session is None
+    self.coalesce = coalesce
+    self.timeout_secs = timeout_secs
+    self.max_retries = max_retries
+    self.backoff_secs = backoff_secs
+    self.hedge = hedge
+    self._hedge_executor: concurrent.futures.ThreadPoolExecutor | None = None
+    # Latencies of successful requests, used to pick the hedging delay.
+    self.latencies = utils.LatencyWindow()
+    self.hedged_requests = 0
 
   def point(self, query: str) -> base.DataCommonsCall:
     """Calls Data Commons API."""
 
     self.options.vlog(f'... calling DC with "{query}"')
-    response = self._call_api(query, _POINT_PARAMS)
-    # Get the first LINE chart.
-    chart = None
-    for c in response.get('charts', []):
-      ctype = c.get('type')
-      if ctype == 'LINE' or ctype == 'HIGHLIGHT':
-        chart = c
-        break
-    if not chart:
-      return base.DataCommonsCall(query=query)
-
-    v = str(chart.get('highlight', {}).get('value', ''))
-    v = utils.round_float(v)
-    if not v:
-      return base.DataCommonsCall(query=query)
-
-    u = chart.get('unit', '')
-    d = chart.get('highlight', {}).get('date')
-    s = _src(chart)
-    t = chart.get('title', '')
-
-    svm = response.get('debug', {}).get('debug', {}).get('sv_matching', {})
-    score = svm.get('CosineScore', [-1])[0]
-    var = svm.get('SV', [''])[0]
-    url = chart.get('dcUrl', '')
-    if url:
-      url += f'&mode={_POINT_MODE}'
-    return base.DataCommonsCall(
-        query=query,
-        val=v,
-        unit=u,
-        title=t,
-        date=d,
-        src=s,
-        url=url,
-        var=var,
-        score=score,
-    )
+    return self._fetch(query, _POINT_MODE, _POINT_PARAMS, _parse_point)
 
   def table(self, query: str) -> base.DataCommonsCall:
     """Calls Data Commons API."""
 
     self.options.vlog(f'... calling DC for table with "{query}"')
-    response = self._call_api(query, _TABLE_PARAMS)
-    # Get the first chart.
-    charts = response.get('charts')
-    if not charts:
-      return base.DataCommonsCall(query=query)
-    chart = charts[0]
-
-    data_csv = chart.get('data_csv', '')
-    rows = list(csv.reader(io.StringIO(data_csv)))
-    if not data_csv or not rows:
-      return base.DataCommonsCall(query=query)
-
-    u = chart.get('unit', '')
-    s = _src(chart)
-    t = chart.get('title', '')
-
-    parts = []
-    parts.append(' | '.join(rows[0]))
-    parts.append('-' * len(parts[-1]))
-    for row in rows[1:]:
-      row = [utils.round_float(v) for v in row]
-      parts.append(' | '.join(row))
-    parts.append('\n')
-    table_str = '\n'.join(parts)
-
-    svm = response.get('debug', {}).get('debug', {}).get('sv_matching', {})
-    score = svm.get('CosineScore', [-1])[0]
-    var = svm.get('SV', [''])[0]
-    url = chart.get('dcUrl', '')
-    if url:
-      url += f'&mode={_TABLE_MODE}'
-    return base.DataCommonsCall(
-        query=query,
-        unit=u,
-        title=t,
-        src=s,
-        table=table_str,
-        url=url,
-        var=var,
-        score=score,
-    )
+    return self._fetch(query, _TABLE_MODE, _TABLE_PARAMS, _parse_table)
 
   def calln(
       self, queries: list[str], func: Callable[[str], base.DataCommonsCall]
   ) -> dict[str, base.DataCommonsCall]:
-    """Calls Data Commons API in parallel if needed."""
+    """Calls Data Commons API in parallel if needed.
+
+    A failed query does not fail the batch; its response has `error` set.
+    """
 
-    if self.num_threads == 1:
-      results = [func(q) for q in queries]
+    if self.max_threads == 1 or len(queries) <= 1:
+      results = [_isolated(func, q) for q in queries]
     else:
       # TODO: Check why this ~breaks in Colab Borg runtime
-      with concurrent.futures.ThreadPoolExecutor(self.num_threads) as executor:
-        futures = [executor.submit(func, query) for query in queries]
-        results = [f.result() for f in futures]
+      executor = self._get_executor()
+      futures = [
+          executor.submit(tracing.wrap(_isolated), func, query)
+          for query in queries
+      ]
+      results = [f.result() for f in futures]
 
     q2resp: dict[str, base.DataCommonsCall] = {}
     for i, (q, r) in enumerate(zip(queries, results)):
@@ -162,13 +221,492 @@ class DataCommons:
       q2resp[q] = r
     return q2resp
 
-  def _call_api(self, query: str, extra_params: str) -> Any:
+  def submit(
+      self, query: str, func: Callable[[str], base.DataCommonsCall]
+  ) -> concurrent.futures.Future[base.DataCommonsCall]:
+    """Starts a single call in the background, e.g., while an LLM streams.
+
+    Like `calln`, a failure is returned as a response with `error` set.
+    """
+    return self._get_executor().submit(tracing.wrap(_isolated), func, query)
+
+  async def apoint(self, query: str) -> base.DataCommonsCall:
+    """Calls Data Commons API without blocking the event loop."""
+
+    self.options.vlog(f'... calling DC with "{query}"')
+    return await self._afetch(query, _POINT_MODE, _POINT_PARAMS, _parse_point)
+
+  async def atable(self, query: str) -> base.DataCommonsCall:
+    """Calls Data Commons API without blocking the event loop."""
+
+    self.options.vlog(f'... calling DC for table with "{query}"')
+    return await self._afetch(query, _TABLE_MODE, _TABLE_PARAMS, _parse_table)
+
+  async def acalln(
+      self,
+      queries: list[str],
+      func: Callable[[str], Awaitable[base.DataCommonsCall]],
+  ) -> dict[str, base.DataCommonsCall]:
+    """Calls Data Commons API concurrently.
+
+    Concurrency is bounded by the process-wide async limit, see
+    `set_async_concurrency`.  A failed query does not fail the batch; its
+    response has `error` set.
+    """
+
+    results = await asyncio.gather(*[_aisolated(func, q) for q in queries])
+
+    q2resp: dict[str, base.DataCommonsCall] = {}
+    for i, (q, r) in enumerate(zip(queries, results)):
+      r.id = i + 1
+      q2resp[q] = r
+    return q2resp
+
+  def close(self) -> None:
+    """Releases the worker threads and HTTP connections held here."""
+    with self._executor_lock:
+      if self._executor:
+        self._executor.shutdown(wait=True)
+        self._executor = None
+      if self._hedge_executor:
+        # Losing hedges may still be running; don't wait for them.
+        self._hedge_executor.shutdown(wait=False)
+        self._hedge_executor = None
+    if self._owns_session:
+      self.session.close()
+
+  def __enter__(self) -> 'DataCommons':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def concurrency_stats(self) -> dict[str, float]:
+    """Returns the current concurrency limit and recent latency percentiles."""
+    if self.limiter:
+      return self.limiter.stats()
+    return {
+        'limit': self.num_threads,
+        'p50_secs': self.latencies.percentile(50),
+        'p95_secs': self.latencies.percentile(95),
+        'p99_secs': self.latencies.percentile(99),
+    }
+
+  async def aclose(self) -> None:
+    """Closes the async HTTP session if it was created here."""
+    if self._owns_async_session and self.async_session:
+      await self.async_session.close()
+      self.async_session = None
+
+  def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+    with self._executor_lock:
+      if not self._executor:
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            self.max_threads, thread_name_prefix='datacommons'
+        )
+      return self._executor
+
+  def _get_hedge_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+    with self._executor_lock:
+      if not self._hedge_executor:
+        # Room for a primary and a hedge per worker.
+        self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+            2 * self.max_threads, thread_name_prefix='datacommons-hedge'
+        )
+      return self._hedge_executor
+
+  def _fetch(
+      self,
+      query: str,
+      mode: str,
+      extra_params: str,
+      parse: Callable[[str, Any], base.DataCommonsCall],
+  ) -> base.DataCommonsCall:
+    """Returns the parsed response for query, going via the cache if any."""
+    with tracing.span('dc.fetch', mode=mode, query=query) as s:
+      if self.cache:
+        resp = self.cache.get(self.env, mode, query)
+        s.set(cache_hit=resp is not None)
+        if resp is not None:
+          _FETCHES.labels(mode, 'cache').inc()
+          return resp
+
+      leader = False
+
+      def _call() -> base.DataCommonsCall:
+        nonlocal leader
+        leader = True
+        s.set(leader=True)
+        resp = parse(query, self._call_api(query, extra_params))
+        if self.cache:
+          self.cache.put(self.env, mode, query, resp)
+        return resp
+
+      if not self.coalesce:
+        resp = _call()
+      else:
+        resp = _SINGLE_FLIGHT.do(
+            dc_cache.cache_key(self.env, mode, query), _call
+        )
+        # Callers may mutate the result (e.g., set `id`), so each gets a copy.
+        resp = dataclasses.replace(resp, query=query)
+      _FETCHES.labels(mode, 'network' if leader else 'coalesced').inc()
+      return resp
+
+  async def _afetch(
+      self,
+      query: str,
+      mode: str,
+      extra_params: str,
+      parse: Callable[[str, Any], base.DataCommonsCall],
+  ) -> base.DataCommonsCall:
+    with tracing.span('dc.fetch', mode=mode, query=query) as s:
+      if self.cache:
+        resp = self.cache.get(self.env, mode, query)
+        s.set(cache_hit=resp is not None)
+        if resp is not None:
+          _FETCHES.labels(mode, 'cache').inc()
+          return resp
+
+      leader = False
+
+      async def _call() -> base.DataCommonsCall:
+        nonlocal leader
+        leader = True
+        s.set(leader=True)
+        resp = parse(query, await self._acall_api(query, extra_params))
+        if self.cache:
+          self.cache.put(self.env, mode, query, resp)
+        return resp
+
+      if not self.coalesce:
+        resp = await _call()
+      else:
+        resp = await _SINGLE_FLIGHT.ado(
+            dc_cache.cache_key(self.env, mode, query), _call
+        )
+        resp = dataclasses.replace(resp, query=query)
+      _FETCHES.labels(mode, 'network' if leader else 'coalesced').inc()
+      return resp
+
+  def _url(self, query: str, extra_params: str) -> str:
     query = query.strip().replace(' ', '+')
-    url = _BASE_URL.format(env=self.env) + f'?&q={query}&{extra_params}'
+    url = self.base_url.format(env=self.env) + f'?&q={query}&{extra_params}'
     if self.api_key:
       url = f'{url}&key={self.api_key}'
+    return url
+
+  def _call_api(self, query: str, extra_params: str) -> Any:
+    url = self._url(query, extra_params)
     # print(f'DC: Calling {url}')
-    return self.session.get(url).json()
+    if self.hedge:
+      return self._hedged_get(url)
+    return self._get(url)
+
+  async def _acall_api(self, query: str, extra_params: str) -> Any:
+    url = self._url(query, extra_params)
+    if self.hedge:
+      return await self._ahedged_get(url)
+    return await self._aget(url)
+
+  def _get(self, url: str) -> Any:
+    """GETs url, retrying timeouts, 429s and 5xxs with jittered backoff."""
+    attempt = 0
+    while True:
+      if self.limiter:
+        self.limiter.acquire()
+      start = time.time()
+      s = tracing.start_span('dc.http', attempt=attempt)
+      _HTTP_IN_FLIGHT.labels().inc()
+      # Any failure, including ones that aren't retried (e.g., a truncated
+      # body), must release the limiter slot.
+      ok = False
+      r = None
+      try:
+        r = self.session.get(url, timeout=self.timeout_secs)
+        s.set(status=r.status_code, response_bytes=len(r.content))
+        ok = r.status_code not in _RETRY_STATUSES
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        r = None
+        s.set(error=_redact(repr(e)))
+        _HTTP_REQUESTS.labels('error').inc()
+        if attempt >= self.max_retries or not isinstance(
+            e, (requests.ConnectionError, requests.Timeout)
+        ):
+          raise _redacted(e) from None
+        delay = _backoff_secs(attempt, self.backoff_secs)
+      else:
+        _HTTP_REQUESTS.labels(str(r.status_code)).inc()
+        _HTTP_SECONDS.observe(time.time() - start)
+      finally:
+        s.end()
+        _HTTP_IN_FLIGHT.labels().dec()
+        if self.limiter:
+          self.limiter.release(time.time() - start, ok=ok)
+      if r is not None:
+        if ok:
+          self.latencies.add(time.time() - start)
+          return r.json()
+        if attempt >= self.max_retries:
+          raise _http_error(r.status_code, url)
+        delay = _backoff_secs(
+            attempt, self.backoff_secs, r.headers.get('Retry-After')
+        )
+      attempt += 1
+      time.sleep(delay)
+
+  async def _aget(self, url: str) -> Any:
+    """Async version of `_get`."""
+    session = self._get_async_session()
+    timeout = aiohttp.ClientTimeout(total=self.timeout_secs)
+    attempt = 0
+    while True:
+      start = time.time()
+      try:
+        async with _async_semaphore():
+          _HTTP_IN_FLIGHT.labels().inc()
+          try:
+            with tracing.span('dc.http', attempt=attempt) as s:
+              async with session.get(url, timeout=timeout) as r:
+                body = await r.read()
+                s.set(status=r.status, response_bytes=len(body))
+          except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            _HTTP_REQUESTS.labels('error').inc()
+            raise
+          finally:
+            _HTTP_IN_FLIGHT.labels().dec()
+          _HTTP_REQUESTS.labels(str(r.status)).inc()
+          _HTTP_SECONDS.observe(time.time() - start)
+          if r.status not in _RETRY_STATUSES:
+            resp = await r.json(content_type=None)
+            self.latencies.add(time.time() - start)
+            return resp
+          if attempt >= self.max_retries:
+            raise _http_error(r.status, url)
+          delay = _backoff_secs(
+              attempt, self.backoff_secs, r.headers.get('Retry-After')
+          )
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        if attempt >= self.max_retries:
+          raise
+        delay = _backoff_secs(attempt, self.backoff_secs)
+      attempt += 1
+      await asyncio.sleep(delay)
+
+  def _hedge_delay(self) -> float:
+    if len(self.latencies) < _HEDGE_MIN_SAMPLES:
+      return 0
+    return self.latencies.percentile(_HEDGE_PERCENTILE)
+
+  def _hedged_get(self, url: str) -> Any:
+    """Like `_get`, but sends a duplicate request if the first is slow."""
+    delay = self._hedge_delay()
+    if not delay:
+      return self._get(url)
+    executor = self._get_hedge_executor()
+    primary = executor.submit(tracing.wrap(self._get), url)
+    try:
+      return primary.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+      pass
+
+    self.hedged_requests += 1
+    _HEDGED_REQUESTS.inc()
+    pending = {primary, executor.submit(tracing.wrap(self._get), url)}
+    error = None
+    while pending:
+      done, pending = concurrent.futures.wait(
+          pending, return_when=concurrent.futures.FIRST_COMPLETED
+      )
+      for f in done:
+        if f.exception() is None:
+          return f.result()
+        error = f.exception()
+    raise error
+
+  async def _ahedged_get(self, url: str) -> Any:
+    """Async version of `_hedged_get`."""
+    delay = self._hedge_delay()
+    if not delay:
+      return await self._aget(url)
+    primary = asyncio.ensure_future(self._aget(url))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+      return primary.result()
+
+    self.hedged_requests += 1
+    _HEDGED_REQUESTS.inc()
+    pending = {primary, asyncio.ensure_future(self._aget(url))}
+    error = None
+    try:
+      while pending:
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED
+        )
+        for t in done:
+          if t.exception() is None:
+            return t.result()
+          error = t.exception()
+      raise error
+    finally:
+      for t in pending:
+        t.cancel()
+
+  def _get_async_session(self) -> Any:
+    if self.async_session is None or self.async_session.closed:
+      self.async_session = utils.new_async_session()
+      self._owns_async_session = True
+    return self.async_session
+
+
+def _isolated(
+    func: Callable[[str], base.DataCommonsCall], query: str
+) -> base.DataCommonsCall:
+  try:
+    return func(query)
+  except Exception as e:  # pylint: disable=broad-exception-caught
+    error = _redact(repr(e))
+    logging.warning('DC call failed for "%s": %s', query, error)
+    return base.DataCommonsCall(query=query, error=error)
+
+
+async def _aisolated(
+    func: Callable[[str], Awaitable[base.DataCommonsCall]], query: str
+) -> base.DataCommonsCall:
+  try:
+    return await func(query)
+  except Exception as e:  # pylint: disable=broad-exception-caught
+    error = _redact(repr(e))
+    logging.warning('DC call failed for "%s": %s', query, error)
+    return base.DataCommonsCall(query=query, error=error)
+
+
+def _redact(text: str) -> str:
+  return _KEY_PARAM.sub('&key=REDACTED', text)
+
+
+def _redacted(e: Exception) -> Exception:
+  """Returns e, or a copy of it without the API key in its message."""
+  if isinstance(e, requests.RequestException) and _KEY_PARAM.search(str(e)):
+    return type(e)(_redact(str(e)))
+  return e
+
+
+def _http_error(status: int, url: str) -> requests.HTTPError:
+  """Returns an error for a failed GET of url, without its API key."""
+  return requests.HTTPError(f'DC returned HTTP {status} for {_redact(url)}')
+
+
+def _backoff_secs(
+    attempt: int, backoff_secs: float, retry_after: str | None = None
+) -> float:
+  """Returns a full-jitter exponential backoff, honoring Retry-After."""
+  delay = random.uniform(0, backoff_secs * 2**attempt)
+  if retry_after and retry_after.isdigit():
+    delay = max(delay, float(retry_after))
+  return min(delay, _MAX_BACKOFF_SECS)
+
+
+def _new_session(num_threads: int) -> requests.Session:
+  """Returns a session that keeps a warm connection per worker thread."""
+  session = requests.Session()
+  adapter = adapters.HTTPAdapter(
+      pool_connections=1,
+      pool_maxsize=max(num_threads, adapters.DEFAULT_POOLSIZE),
+      max_retries=retry.Retry(
+          total=None, connect=_CONNECT_RETRIES, read=0, redirect=3, status=0
+      ),
+  )
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+def _parse_point(query: str, response: Any) -> base.DataCommonsCall:
+  """Parses a `toolformer_rig` response into a point value."""
+
+  # Get the first LINE chart.
+  chart = None
+  for c in response.get('charts', []):
+    ctype = c.get('type')
+    if ctype == 'LINE' or ctype == 'HIGHLIGHT':
+      chart = c
+      break
+  if not chart:
+    return base.DataCommonsCall(query=query)
+
+  v = str(chart.get('highlight', {}).get('value', ''))
+  v = utils.round_float(v)
+  if not v:
+    return base.DataCommonsCall(query=query)
+
+  u = chart.get('unit', '')
+  d = chart.get('highlight', {}).get('date')
+  s = _src(chart)
+  t = chart.get('title', '')
+
+  svm = response.get('debug', {}).get('debug', {}).get('sv_matching', {})
+  score = svm.get('CosineScore', [-1])[0]
+  var = svm.get('SV', [''])[0]
+  url = chart.get('dcUrl', '')
+  if url:
+    url += f'&mode={_POINT_MODE}'
+  return base.DataCommonsCall(
+      query=query,
+      val=v,
+      unit=u,
+      title=t,
+      date=d,
+      src=s,
+      url=url,
+      var=var,
+      score=score,
+  )
+
+
+def _parse_table(query: str, response: Any) -> base.DataCommonsCall:
+  """Parses a `toolformer_rag` response into a table."""
+
+  # Get the first chart.
+  charts = response.get('charts')
+  if not charts:
+    return base.DataCommonsCall(query=query)
+  chart = charts[0]
+
+  data_csv = chart.get('data_csv', '')
+  rows = list(csv.reader(io.StringIO(data_csv)))
+  if not data_csv or not rows:
+    return base.DataCommonsCall(query=query)
+
+  u = chart.get('unit', '')
+  s = _src(chart)
+  t = chart.get('title', '')
+
+  parts = []
+  parts.append(' | '.join(rows[0]))
+  parts.append('-' * len(parts[-1]))
+  for row in rows[1:]:
+    row = [utils.round_float(v) for v in row]
+    parts.append(' | '.join(row))
+  parts.append('\n')
+  table_str = '\n'.join(parts)
+
+  svm = response.get('debug', {}).get('debug', {}).get('sv_matching', {})
+  score = svm.get('CosineScore', [-1])[0]
+  var = svm.get('SV', [''])[0]
+  url = chart.get('dcUrl', '')
+  if url:
+    url += f'&mode={_TABLE_MODE}'
+  return base.DataCommonsCall(
+      query=query,
+      unit=u,
+      title=t,
+      src=s,
+      table=table_str,
+      url=url,
+      var=var,
+      score=score,
+  )
 
 
 def _src(chart: dict[str, Any]) -> str:
@@ -14,14 +14,17 @@
 
 """LLM Interface."""
 
+import copy
 import json
 import logging
 import time
-from typing import Any
+from typing import Any, Iterator
 
 import requests
 
 from data_gemma import base
+from data_gemma import tracing
+from data_gemma import utils
 
 
 _REQ_DATA = {
@@ -57,6 +60,7 @@ class GoogleAIStudio(base.LLM):
       api_keys: list[str],
       verbose: bool = True,
       session: requests.Session | None = None,
+      async_session: Any = None,
   ):
     self.keys = api_keys
     if not session:
@@ -65,16 +69,14 @@ class GoogleAIStudio(base.LLM):
     self.next_key_idx = 0
     self.options = base.Options(verbose=verbose)
     self.model = model
+    # An `aiohttp.ClientSession`, created lazily unless one is passed in.
+    self.async_session = async_session
+    self._owns_async_session = async_session is None
 
+  @tracing.llm_call
   def query(self, prompt: str) -> base.LLMCall:
-    req_data = _REQ_DATA.copy()
-
-    # set the params.
-    req_data['generationConfig']['temperature'] = 0.1
-    req_data['contents'][0]['parts'][0]['text'] = prompt
-
     # Make API request.
-    req = json.dumps(req_data)
+    req = json.dumps(_req_data(prompt))
 
     start = time.time()
     self.options.vlog(
@@ -82,25 +84,70 @@ class GoogleAIStudio(base.LLM):
     )
     resp = _call_api(self.session, self.model, self._get_key(), req)
     t = round(time.time() - start, 3)
-    ans = ''
+    ans, err = _parse(resp)
+    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+
+  @tracing.llm_call
+  async def aquery(self, prompt: str) -> base.LLMCall:
+    req = json.dumps(_req_data(prompt))
+
+    start = time.time()
+    self.options.vlog(
+        f'... calling AIStudio {self.model} "{prompt[:50].strip()}..."'
+    )
+    if self.async_session is None or self.async_session.closed:
+      self.async_session = utils.new_async_session()
+      self._owns_async_session = True
+    resp = await _acall_api(
+        self.async_session, self.model, self._get_key(), req
+    )
+    t = round(time.time() - start, 3)
+    ans, err = _parse(resp)
+    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+
+  async def aclose(self) -> None:
+    """Closes the async HTTP session if it was created here."""
+    if self._owns_async_session and self.async_session:
+      await self.async_session.close()
+      self.async_session = None
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    """Streams the response using `streamGenerateContent`."""
+    req = json.dumps(_req_data(prompt))
+
+    start = time.time()
+    self.options.vlog(
+        f'... streaming AIStudio {self.model} "{prompt[:50].strip()}..."'
+    )
+    parts = []
+    ttft = None
     err = ''
-    if (
-        'candidates' in resp
-        and resp['candidates']
-        and 'content' in resp['candidates'][0]
-        and 'parts' in resp['candidates'][0]['content']
-        and resp['candidates'][0]['content']['parts']
-        and 'text' in resp['candidates'][0]['content']['parts'][0]
-    ):
-      ans = resp['candidates'][0]['content']['parts'][0]['text']
-    elif 'error' not in resp:
+    try:
+      for resp in _stream_api(self.session, self.model, self._get_key(), req):
+        if 'error' in resp:
+          err = json.dumps(resp)
+          break
+        text = _text(resp)
+        if text:
+          if ttft is None:
+            ttft = round(time.time() - start, 3)
+          parts.append(text)
+          yield text
+    except (requests.RequestException, ValueError) as e:
+      err = str(e)
+    t = round(time.time() - start, 3)
+
+    ans = ''.join(parts)
+    if err:
+      logging.error('%s', err)
+    elif not ans:
       err = 'Got empty response'
       logging.warning(err)
-    else:
-      err = json.dumps(resp)
-      logging.error('%s', err)
 
-    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+    yield base.LLMCall(
+        prompt=prompt, response=ans, duration_secs=t, error=err, ttft_secs=ttft
+    )
 
   def _get_key(self):
     key = self.keys[self.next_key_idx]
@@ -114,6 +161,45 @@ _BASE_URL = 'https://generativelanguage.googleapis.com/v1beta/models'
 _API_HEADER = {'content-type': 'application/json'}
 
 
+def _req_data(prompt: str) -> dict[str, Any]:
+  # Deep copy, since the template is shared by concurrent queries.
+  req_data = copy.deepcopy(_REQ_DATA)
+
+  # set the params.
+  req_data['generationConfig']['temperature'] = 0.1
+  req_data['contents'][0]['parts'][0]['text'] = prompt
+  return req_data
+
+
+def _text(resp: dict[str, Any]) -> str:
+  """Returns the text of the first candidate, or an empty string."""
+  candidates = resp.get('candidates') or [{}]
+  parts = candidates[0].get('content', {}).get('parts') or [{}]
+  return parts[0].get('text', '')
+
+
+def _parse(resp: Any) -> tuple[str, str]:
+  """Returns the answer and error from a generateContent response."""
+  ans = ''
+  err = ''
+  if (
+      'candidates' in resp
+      and resp['candidates']
+      and 'content' in resp['candidates'][0]
+      and 'parts' in resp['candidates'][0]['content']
+      and resp['candidates'][0]['content']['parts']
+      and 'text' in resp['candidates'][0]['content']['parts'][0]
+  ):
+    ans = resp['candidates'][0]['content']['parts'][0]['text']
+  elif 'error' not in resp:
+    err = 'Got empty response'
+    logging.warning(err)
+  else:
+    err = json.dumps(resp)
+    logging.error('%s', err)
+  return ans, err
+
+
 def _call_api(
     session: requests.Session, model: str, key: str, req_data: str
 ) -> Any:
@@ -123,3 +209,29 @@ def _call_api(
       headers=_API_HEADER,
   )
   return r.json()
+
+
+async def _acall_api(session: Any, model: str, key: str, req_data: str) -> Any:
+  async with session.post(
+      f'{_BASE_URL}/{model}:generateContent?key={key}',
+      data=req_data,
+      headers=_API_HEADER,
+  ) as r:
+    return await r.json(content_type=None)
+
+
+def _stream_api(
+    session: requests.Session, model: str, key: str, req_data: str
+) -> Iterator[Any]:
+  with session.post(
+      f'{_BASE_URL}/{model}:streamGenerateContent?alt=sse&key={key}',
+      data=req_data,
+      headers=_API_HEADER,
+      stream=True,
+  ) as r:
+    if r.status_code != 200:
+      yield r.json()
+      return
+    for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+      if line and line.startswith('data:'):
+        yield json.loads(line[len('data:'):])
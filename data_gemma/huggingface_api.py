@@ -13,14 +13,25 @@
 # limitations under the License.
 """HF Pipeline API based LLM Interface."""
 
+import copy
 import logging
+import string
+import threading
 import time
-from typing import Any
+from typing import Any, Callable, Iterator
 
 from data_gemma import base
+from data_gemma import prompts
+from data_gemma import tracing
 
 MAX_NEW_TOKENS = 4096
 
+# Template text shorter than this isn't worth caching the KV of.
+_MIN_PREFIX_CHARS = 256
+
+# Default number of prompts per `query_batch` generate call.
+_BATCH_SIZE = 8
+
 
 class HFPipeline(base.LLM):
   """HuggingFace Pipeline API."""
@@ -29,10 +40,13 @@ class HFPipeline(base.LLM):
       self,
       pipeline: Any,
       verbose: bool = True,
+      batch_size: int = _BATCH_SIZE,
   ):
     self.pipeline = pipeline
     self.options = base.Options(verbose=verbose)
+    self.batch_size = batch_size
 
+  @tracing.llm_call
   def query(self, prompt: str) -> base.LLMCall:
     self.options.vlog(f'... calling HF Pipeline API "{prompt[:50].strip()}..."')
 
@@ -55,11 +69,74 @@ class HFPipeline(base.LLM):
 
     return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
 
+  @tracing.llm_call
+  def query_batch(
+      self, prompts: list[str], batch_size: int = 0
+  ) -> list[base.LLMCall]:
+    """Queries prompts in length-bucketed batches.
+
+    Returns one LLMCall per prompt, in order.  Each call's duration is that
+    of the batch it ran in.
+    """
+    batch_size = batch_size or self.batch_size
+    self.options.vlog(
+        f'... calling HF Pipeline API for {len(prompts)} prompts in batches'
+        f' of {batch_size}'
+    )
+    tokenizer = self.pipeline.tokenizer
+    _prepare_for_batching(tokenizer)
+
+    results: list[base.LLMCall | None] = [None] * len(prompts)
+    for idxs in _length_batches(tokenizer, prompts, batch_size):
+      batch = [prompts[i] for i in idxs]
+      start = time.time()
+      answers = [''] * len(batch)
+      err = ''
+      try:
+        outputs = self.pipeline(
+            batch,
+            batch_size=len(batch),
+            max_new_tokens=MAX_NEW_TOKENS,
+            return_full_text=False,
+        )
+        answers = [o[0]['generated_text'] for o in outputs]
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        err = str(e)
+        logging.warning(err)
+        print(f'WARNING: {err}')
+      t = round(time.time() - start, 3)
+      for i, ans in zip(idxs, answers):
+        results[i] = base.LLMCall(
+            prompt=prompts[i], response=ans, duration_secs=t, error=err
+        )
+    return results
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    self.options.vlog(
+        f'... streaming HF Pipeline API "{prompt[:50].strip()}..."'
+    )
+
+    def _generate(streamer: Any) -> None:
+      self.pipeline(
+          prompt,
+          max_new_tokens=MAX_NEW_TOKENS,
+          return_full_text=False,
+          streamer=streamer,
+      )
+
+    yield from _stream(prompt, self.pipeline.tokenizer, _generate)
+
 
 class HFBasic(base.LLM):
   """HuggingFace Model / Tokenizer API.
 
-  Note: Model is assumed to be loaded on a GPU.
+  Note: Model is assumed to be loaded on `device`, a GPU by default.
+
+  With `prefix_cache`, the past key-values of static prompt prefixes, by
+  default the instructions of the templates in `prompts`, are computed once
+  and single prompts starting with one only prefill the rest.  More can be
+  added with `register_prefix`.
   """
 
   def __init__(
@@ -67,16 +144,36 @@ class HFBasic(base.LLM):
       model: Any,
       tokenizer: Any,
       verbose: bool = True,
+      device: str = 'cuda',
+      batch_size: int = _BATCH_SIZE,
+      prefix_cache: bool = False,
   ):
     self.model = model
     self.tokenizer = tokenizer
     self.options = base.Options(verbose=verbose)
+    self.device = device
+    self.batch_size = batch_size
+
+    # Prefix -> (token ids, past key-values), computed on first use.
+    self._prefixes: dict[str, tuple[list[int], Any] | None] = {}
+    self._prefix_lock = threading.Lock()
+    self.prefix_hits = 0
+    self.reused_prefix_tokens = 0
+    if prefix_cache:
+      for prefix in _template_prefixes():
+        self.register_prefix(prefix)
 
+  def register_prefix(self, prefix: str) -> None:
+    """Caches the KV of prefix for prompts that start with it."""
+    with self._prefix_lock:
+      self._prefixes.setdefault(prefix, None)
+
+  @tracing.llm_call
   def query(self, prompt: str) -> base.LLMCall:
     self.options.vlog(f'... calling HF Pipeline API "{prompt[:50].strip()}..."')
 
     start = time.time()
-    inputs = self.tokenizer(prompt, return_tensors='pt').to('cuda')
+    inputs = self._inputs(prompt)
     input_ids = inputs['input_ids']
     outputs = self.model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS)
 
@@ -93,3 +190,195 @@ class HFBasic(base.LLM):
     t = round(time.time() - start, 3)
 
     return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+
+  @tracing.llm_call
+  def query_batch(
+      self, prompts: list[str], batch_size: int = 0
+  ) -> list[base.LLMCall]:
+    """Queries prompts in left-padded, length-bucketed batches.
+
+    Returns one LLMCall per prompt, in order.  Each call's duration is that
+    of the batch it ran in.
+    """
+    batch_size = batch_size or self.batch_size
+    self.options.vlog(
+        f'... calling HF Model API for {len(prompts)} prompts in batches of'
+        f' {batch_size}'
+    )
+    _prepare_for_batching(self.tokenizer)
+
+    results: list[base.LLMCall | None] = [None] * len(prompts)
+    for idxs in _length_batches(self.tokenizer, prompts, batch_size):
+      batch = [prompts[i] for i in idxs]
+      start = time.time()
+      answers = [''] * len(batch)
+      err = ''
+      try:
+        inputs = self.tokenizer(batch, return_tensors='pt', padding=True).to(
+            self.device
+        )
+        outputs = self.model.generate(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        # With left padding, every prompt ends at the same column.
+        answers = self.tokenizer.batch_decode(
+            outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True
+        )
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        err = str(e)
+        logging.warning(err)
+        print(f'WARNING: {err}')
+      t = round(time.time() - start, 3)
+      for i, ans in zip(idxs, answers):
+        results[i] = base.LLMCall(
+            prompt=prompts[i], response=ans, duration_secs=t, error=err
+        )
+    return results
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    self.options.vlog(
+        f'... streaming HF Pipeline API "{prompt[:50].strip()}..."'
+    )
+
+    def _generate(streamer: Any) -> None:
+      self.model.generate(
+          **self._inputs(prompt),
+          max_new_tokens=MAX_NEW_TOKENS,
+          streamer=streamer,
+      )
+
+    yield from _stream(prompt, self.tokenizer, _generate)
+
+  def _inputs(self, prompt: str) -> dict[str, Any]:
+    """Returns the generate inputs, with the KV of a cached prefix if any."""
+    inputs = dict(self.tokenizer(prompt, return_tensors='pt').to(self.device))
+    with self._prefix_lock:
+      prefixes = list(self._prefixes)
+    prefix = max(
+        (p for p in prefixes if prompt.startswith(p)),
+        key=len,
+        default=None,
+    )
+    if prefix is None:
+      return inputs
+    prefix_ids, kv = self._prefix_kv(prefix)
+
+    # Tokens may merge across the end of the prefix, so only reuse the KV of
+    # the tokens both share.  At least one token must be left to prefill.
+    ids = inputs['input_ids'][0].tolist()
+    n = 0
+    limit = min(len(prefix_ids), len(ids) - 1)
+    while n < limit and prefix_ids[n] == ids[n]:
+      n += 1
+    if not n:
+      return inputs
+    # generate() extends the cache in place, so each call gets a copy.
+    kv = copy.deepcopy(kv)
+    if n < len(prefix_ids):
+      # A negative value drops that many tokens, in all transformers versions.
+      kv.crop(n - len(prefix_ids))
+    inputs['past_key_values'] = kv
+    with self._prefix_lock:
+      self.prefix_hits += 1
+      self.reused_prefix_tokens += n
+    return inputs
+
+  def _prefix_kv(self, prefix: str) -> tuple[list[int], Any]:
+    with self._prefix_lock:
+      entry = self._prefixes.get(prefix)
+      if entry is None:
+        # Imported here so that torch is only needed by HF users.
+        import torch  # pylint: disable=g-import-not-at-top
+
+        inputs = self.tokenizer(prefix, return_tensors='pt').to(self.device)
+        with torch.no_grad():
+          out = self.model(**inputs, use_cache=True)
+        entry = (inputs['input_ids'][0].tolist(), out.past_key_values)
+        self._prefixes[prefix] = entry
+      return entry
+
+
+def _template_prefixes() -> list[str]:
+  """Returns the static text before the first field of each prompt template."""
+  prefixes = []
+  for name, value in vars(prompts).items():
+    if not name.isupper() or not isinstance(value, str):
+      continue
+    literal = next(string.Formatter().parse(value), ('',))[0]
+    if len(literal) >= _MIN_PREFIX_CHARS:
+      prefixes.append(literal)
+  return prefixes
+
+
+def _prepare_for_batching(tokenizer: Any) -> None:
+  """Sets up a decoder-only tokenizer for padded batches."""
+  # Pad on the left so that generation continues right after each prompt.
+  tokenizer.padding_side = 'left'
+  if tokenizer.pad_token is None:
+    tokenizer.pad_token = tokenizer.eos_token
+
+
+def _length_batches(
+    tokenizer: Any, prompts: list[str], batch_size: int
+) -> list[list[int]]:
+  """Groups prompt indices into batches of similar token length.
+
+  This keeps a short prompt from being padded to the length of a long one.
+  """
+  lengths = [len(ids) for ids in tokenizer(prompts)['input_ids']]
+  order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+  return [
+      order[i : i + batch_size] for i in range(0, len(order), batch_size)
+  ]
+
+
+def _stream(
+    prompt: str, tokenizer: Any, generate: Callable[[Any], None]
+) -> Iterator[str | base.LLMCall]:
+  """Runs generate(streamer) in a thread and yields text as it decodes."""
+  # Imported here so that transformers is only needed by HF users.
+  import transformers  # pylint: disable=g-import-not-at-top
+
+  streamer = transformers.TextIteratorStreamer(
+      tokenizer, skip_prompt=True, skip_special_tokens=True
+  )
+  errors = []
+
+  def _run() -> None:
+    try:
+      generate(streamer)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      errors.append(str(e))
+      # Unblock the consumer below.
+      streamer.end()
+
+  start = time.time()
+  thread = threading.Thread(target=_run, daemon=True)
+  thread.start()
+  parts = []
+  ttft = None
+  for text in streamer:
+    if not text:
+      continue
+    if ttft is None:
+      ttft = round(time.time() - start, 3)
+    parts.append(text)
+    yield text
+  thread.join()
+  t = round(time.time() - start, 3)
+
+  err = errors[0] if errors else ''
+  if err:
+    logging.warning(err)
+    print(f'WARNING: {err}')
+
+  yield base.LLMCall(
+      prompt=prompt,
+      response=''.join(parts),
+      duration_secs=t,
+      error=err,
+      ttft_secs=ttft,
+  )
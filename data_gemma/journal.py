@@ -0,0 +1,271 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Append-only journal of ID keyed result rows.
+
+A journal for `results.csv` keeps new rows in `results.csv.journal/` as
+JSONL segments, plus an `ids` file listing every completed ID.  Compaction
+merges the segments into `results.csv` itself, sorted by key like
+`utils.checkpoint_csv` writes it, so existing CSV readers keep working.
+"""
+
+import csv
+import glob
+import heapq
+import itertools
+import json
+import os
+import threading
+from typing import Any, Iterator
+
+# Rows per segment before starting a new one.
+_SEGMENT_ROWS = 10000
+# Rows between fsyncs.
+_FSYNC_EVERY = 100
+
+_IDS_FILE = 'ids'
+_SEGMENT_GLOB = 'segment-*.jsonl'
+
+
+def journal_dir(csv_file: str) -> str:
+  return f'{csv_file}.journal'
+
+
+def read_segments(csv_file: str) -> Iterator[dict[str, str]]:
+  """Yields rows from the journal segments of csv_file, oldest first."""
+  for path in _segment_paths(journal_dir(csv_file)):
+    yield from _read_segment(path)
+
+
+class Journal:
+  """Append-only, crash-safe store of result rows keyed by ID."""
+
+  def __init__(
+      self,
+      csv_file: str,
+      header: list[str],
+      id_column: str,
+      aux_id_column: str = '',
+      fsync_every: int = _FSYNC_EVERY,
+      segment_rows: int = _SEGMENT_ROWS,
+  ):
+    self.csv_file = csv_file
+    self.header = header
+    self.id_column = id_column
+    self.aux_id_column = aux_id_column
+    self.fsync_every = fsync_every
+    self.segment_rows = segment_rows
+
+    self.dir = journal_dir(csv_file)
+    os.makedirs(self.dir, exist_ok=True)
+    self._lock = threading.Lock()
+    self._compact_lock = threading.Lock()
+    self._compactor: threading.Thread | None = None
+
+    self._ids = self._load_ids()
+    self._ids_file = open(os.path.join(self.dir, _IDS_FILE), 'a')
+    # Keys of rows not yet fsynced, which only go to `_ids_file` after their
+    # rows, so a crash can't mark a lost row as done.
+    self._pending_ids: list[str] = []
+    self._segment = None
+    self._segment_num = _segment_num(
+        (_segment_paths(self.dir) or ['segment-0.jsonl'])[-1]
+    )
+    self._segment_count = self.segment_rows  # Start a new segment.
+    self._unsynced = 0
+
+  def completed_ids(self) -> set[str]:
+    """Returns the keys of all rows written so far."""
+    with self._lock:
+      return set(self._ids)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self._ids
+
+  def append(self, row: dict[str, Any]) -> None:
+    """Appends a row; a later row for the same key replaces earlier ones.
+
+    Values are stored as strings, as `csv` would write them, so that rows
+    read back from segments look like rows from the CSV.
+    """
+    row = {k: '' if v is None else str(v) for k, v in row.items()}
+    key = self._key(row)
+    with self._lock:
+      if self._segment_count >= self.segment_rows:
+        self._rotate()
+      self._segment.write(json.dumps(row) + '\n')
+      self._pending_ids.append(key)
+      self._ids.add(key)
+      self._segment_count += 1
+      self._unsynced += 1
+      if self._unsynced >= self.fsync_every:
+        self._sync()
+
+  def flush(self) -> None:
+    with self._lock:
+      self._sync()
+
+  def load(self) -> dict[str, dict[str, str]]:
+    """Returns all rows by key, like `utils.load_csv`."""
+    self.flush()
+    results = {}
+    # Don't read while segments are being merged into the CSV.
+    with self._compact_lock:
+      for row in itertools.chain(
+          self._read_csv(), read_segments(self.csv_file)
+      ):
+        key = self._key(row)
+        if key:
+          results[key] = row
+    return results
+
+  def compact(self, background: bool = False) -> None:
+    """Merges the closed segments into the sorted CSV file.
+
+    The current segment is closed first, so all rows appended so far are
+    included.  With `background`, compaction runs in a thread while appends
+    continue.
+    """
+    # A running compaction deletes the segments it merged, so they must not
+    # be listed again.
+    self.wait_for_compaction()
+    with self._lock:
+      self._sync()
+      self._rotate()
+      segments = [
+          p for p in _segment_paths(self.dir)
+          if _segment_num(p) < self._segment_num
+      ]
+    if not background:
+      self._compact(segments)
+      return
+    self._compactor = threading.Thread(
+        target=self._compact, args=(segments,), name='journal-compact'
+    )
+    self._compactor.start()
+
+  def wait_for_compaction(self) -> None:
+    if self._compactor:
+      self._compactor.join()
+      self._compactor = None
+
+  def close(self) -> None:
+    self.wait_for_compaction()
+    with self._lock:
+      self._sync()
+      if self._segment:
+        self._segment.close()
+        self._segment = None
+      self._ids_file.close()
+
+  def _compact(self, segments: list[str]) -> None:
+    """Streams a merge of the CSV and segments into a new CSV."""
+    if not segments:
+      return
+    with self._compact_lock:
+      # Each segment is small enough to sort in memory; the CSV is already
+      # sorted.  Later sources win for duplicate keys.
+      sources = [self._keyed(self._read_csv(), 0)]
+      for i, path in enumerate(segments):
+        sources.append(self._keyed(self._sorted_segment(path), i + 1))
+      tmp = f'{self.csv_file}.tmp'
+      with open(tmp, 'w', newline='') as f:
+        csvw = csv.DictWriter(f, fieldnames=self.header)
+        csvw.writeheader()
+        merged = heapq.merge(*sources, key=lambda x: (x[0], x[1]))
+        for _, group in itertools.groupby(merged, key=lambda x: x[0]):
+          *_, (_, _, row) = group
+          csvw.writerow(row)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp, self.csv_file)
+      for path in segments:
+        os.remove(path)
+
+  def _sorted_segment(self, path: str) -> Iterator[dict[str, str]]:
+    rows = {self._key(r): r for r in _read_segment(path)}
+    for k in sorted(rows):
+      yield rows[k]
+
+  def _keyed(
+      self, rows: Iterator[dict[str, str]], priority: int
+  ) -> Iterator[tuple[str, int, dict[str, str]]]:
+    for row in rows:
+      key = self._key(row)
+      if key:
+        yield key, priority, row
+
+  def _read_csv(self) -> Iterator[dict[str, str]]:
+    if not os.path.exists(self.csv_file):
+      return
+    with open(self.csv_file, 'r') as f:
+      yield from csv.DictReader(f)
+
+  def _key(self, row: dict[str, str]) -> str:
+    k = row[self.id_column].strip()
+    if self.aux_id_column:
+      k = f'{k}/{row[self.aux_id_column].strip()}'
+    return k
+
+  def _load_ids(self) -> set[str]:
+    path = os.path.join(self.dir, _IDS_FILE)
+    if not os.path.exists(path):
+      # Starting from a plain CSV, e.g., one from `utils.checkpoint_csv`.
+      ids = {self._key(r) for r in self._read_csv()}
+      ids.discard('')
+      with open(path, 'w') as f:
+        f.writelines(f'{k}\n' for k in sorted(ids))
+      return ids
+    with open(path, 'r') as f:
+      return {line.rstrip('\n') for line in f if line.strip()}
+
+  def _rotate(self) -> None:
+    if self._segment:
+      self._sync()
+      self._segment.close()
+    self._segment_num += 1
+    path = os.path.join(self.dir, f'segment-{self._segment_num:06d}.jsonl')
+    self._segment = open(path, 'a')
+    self._segment_count = 0
+
+  def _sync(self) -> None:
+    if self._segment:
+      self._segment.flush()
+      os.fsync(self._segment.fileno())
+    if self._pending_ids:
+      self._ids_file.writelines(f'{k}\n' for k in self._pending_ids)
+      self._ids_file.flush()
+      os.fsync(self._ids_file.fileno())
+      self._pending_ids.clear()
+    self._unsynced = 0
+
+
+def _segment_paths(dir_path: str) -> list[str]:
+  return sorted(
+      glob.glob(os.path.join(dir_path, _SEGMENT_GLOB)), key=_segment_num
+  )
+
+
+def _segment_num(path: str) -> int:
+  name = os.path.basename(path)
+  return int(name[len('segment-'):-len('.jsonl')])
+
+
+def _read_segment(path: str) -> Iterator[dict[str, str]]:
+  with open(path, 'r') as f:
+    for line in f:
+      # Skip a torn last line from a crash.
+      try:
+        yield json.loads(line)
+      except json.JSONDecodeError:
+        continue
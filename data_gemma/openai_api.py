@@ -17,11 +17,15 @@
 import json
 import logging
 import time
-from typing import Any
+from typing import Any, Iterator
 
 import requests
 
 from data_gemma import base
+from data_gemma import tracing
+from data_gemma import utils
+
+_URL = 'https://api.openai.com/v1/chat/completions'
 
 
 class OpenAI(base.LLM):
@@ -33,6 +37,7 @@ class OpenAI(base.LLM):
       api_key: str,
       verbose: bool = True,
       session: requests.Session | None = None,
+      async_session: Any = None,
   ):
     self.key = api_key
     if not session:
@@ -40,19 +45,14 @@ class OpenAI(base.LLM):
     self.session: requests.Session = session
     self.options = base.Options(verbose=verbose)
     self.model = model
+    # An `aiohttp.ClientSession`, created lazily unless one is passed in.
+    self.async_session = async_session
+    self._owns_async_session = async_session is None
 
+  @tracing.llm_call
   def query(self, prompt: str) -> base.LLMCall:
-    # set the params.
-    req_data = {
-        'temperature': 0.1,
-        'model': self.model,
-        'messages': [{
-            'role': 'user',
-            'content': prompt,
-        }],
-    }
     # Make API request.
-    req = json.dumps(req_data)
+    req = json.dumps(self._req_data(prompt))
 
     start = time.time()
     self.options.vlog(
@@ -60,34 +60,138 @@ class OpenAI(base.LLM):
     )
     resp = self._call_api(req)
     t = round(time.time() - start, 3)
-    ans = ''
+    ans, err = _parse(resp)
+    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+
+  @tracing.llm_call
+  async def aquery(self, prompt: str) -> base.LLMCall:
+    req = json.dumps(self._req_data(prompt))
+
+    start = time.time()
+    self.options.vlog(
+        f'... calling OpenAI {self.model} "{prompt[:50].strip()}..."'
+    )
+    resp = await self._acall_api(req)
+    t = round(time.time() - start, 3)
+    ans, err = _parse(resp)
+    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+
+  async def aclose(self) -> None:
+    """Closes the async HTTP session if it was created here."""
+    if self._owns_async_session and self.async_session:
+      await self.async_session.close()
+      self.async_session = None
+
+  @tracing.llm_call
+  def query_stream(self, prompt: str) -> Iterator[str | base.LLMCall]:
+    """Streams the response using server-sent events."""
+    req_data = self._req_data(prompt)
+    req_data['stream'] = True
+    req = json.dumps(req_data)
+
+    start = time.time()
+    self.options.vlog(
+        f'... streaming OpenAI {self.model} "{prompt[:50].strip()}..."'
+    )
+    parts = []
+    ttft = None
     err = ''
-    if 'error' in resp:
-      err = json.dumps(resp)
+    try:
+      for event in self._stream_api(req):
+        if 'error' in event:
+          err = json.dumps(event)
+          break
+        choices = event.get('choices') or [{}]
+        text = choices[0].get('delta', {}).get('content')
+        if text:
+          if ttft is None:
+            ttft = round(time.time() - start, 3)
+          parts.append(text)
+          yield text
+    except (requests.RequestException, ValueError) as e:
+      err = str(e)
+    t = round(time.time() - start, 3)
+
+    ans = ''.join(parts)
+    if err:
       logging.error('%s', err)
       print(err)
-    elif (
-        'choices' in resp
-        and resp['choices']
-        and 'message' in resp['choices'][0]
-        and 'content' in resp['choices'][0]['message']
-    ):
-      ans = resp['choices'][0]['message']['content']
-    else:
+    elif not ans:
       err = 'Got empty response'
       logging.warning(err)
       print(err)
 
-    return base.LLMCall(prompt=prompt, response=ans, duration_secs=t, error=err)
+    yield base.LLMCall(
+        prompt=prompt, response=ans, duration_secs=t, error=err, ttft_secs=ttft
+    )
 
-  def _call_api(self, req_data: str) -> Any:
-    header = {
+  def _req_data(self, prompt: str) -> dict[str, Any]:
+    # set the params.
+    return {
+        'temperature': 0.1,
+        'model': self.model,
+        'messages': [{
+            'role': 'user',
+            'content': prompt,
+        }],
+    }
+
+  def _headers(self) -> dict[str, str]:
+    return {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {self.key}',
     }
+
+  def _call_api(self, req_data: str) -> Any:
     r = self.session.post(
-        'https://api.openai.com/v1/chat/completions',
+        _URL,
         data=req_data,
-        headers=header,
+        headers=self._headers(),
     )
     return r.json()
+
+  async def _acall_api(self, req_data: str) -> Any:
+    if self.async_session is None or self.async_session.closed:
+      self.async_session = utils.new_async_session()
+      self._owns_async_session = True
+    async with self.async_session.post(
+        _URL, data=req_data, headers=self._headers()
+    ) as r:
+      return await r.json(content_type=None)
+
+  def _stream_api(self, req_data: str) -> Iterator[Any]:
+    with self.session.post(
+        _URL, data=req_data, headers=self._headers(), stream=True
+    ) as r:
+      if r.status_code != 200:
+        yield r.json()
+        return
+      for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+        if not line or not line.startswith('data:'):
+          continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+          return
+        yield json.loads(data)
+
+
+def _parse(resp: Any) -> tuple[str, str]:
+  """Returns the answer and error from a chat completions response."""
+  ans = ''
+  err = ''
+  if 'error' in resp:
+    err = json.dumps(resp)
+    logging.error('%s', err)
+    print(err)
+  elif (
+      'choices' in resp
+      and resp['choices']
+      and 'message' in resp['choices'][0]
+      and 'content' in resp['choices'][0]['message']
+  ):
+    ans = resp['choices'][0]['message']['content']
+  else:
+    err = 'Got empty response'
+    logging.warning(err)
+    print(err)
+  return ans, err
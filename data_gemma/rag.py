@@ -14,16 +14,62 @@
 
 """RAG Flow."""
 
+import asyncio
+import concurrent.futures
+import dataclasses
 import logging
+import threading
 import time
+from typing import Callable
 
 from data_gemma import base
 from data_gemma import datacommons
+from data_gemma import metrics
 from data_gemma import prompts
+from data_gemma import retrieval
+from data_gemma import tracing
 from data_gemma import validate
 
 _MAX_QUESTIONS = 25
 
+# Threads running speculative fallback answers.
+_MAX_WORKERS = 8
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+_SPECULATIONS = metrics.counter(
+    'data_gemma_rag_speculations_total',
+    'Speculative fallback answers started, and those used.',
+    ('outcome',),
+)
+
+# Decides, from the DC calls behind the final prompt, whether to start the
+# plain-query fallback answer alongside the table-grounded one.
+SpeculationPolicy = Callable[[list[base.DataCommonsCall]], bool]
+
+
+def speculate_always(dc_calls: list[base.DataCommonsCall]) -> bool:
+  del dc_calls
+  return True
+
+
+def speculate_when_weak(
+    min_tables: int = 2, min_score: float = 0.8
+) -> SpeculationPolicy:
+  """Speculates with fewer than min_tables tables, or none above min_score."""
+
+  def _policy(dc_calls: list[base.DataCommonsCall]) -> bool:
+    scores = [c.score for c in dc_calls if c.table]
+    return len(scores) < min_tables or not scores or max(scores) < min_score
+
+  return _policy
+
+
+@dataclasses.dataclass
+class _State(base.FlowState):
+  questions: list[str] = dataclasses.field(default_factory=list)
+
 
 class RAGFlow(base.Flow):
   """Retrieval Augmented Generation."""
@@ -37,6 +83,11 @@ class RAGFlow(base.Flow):
       in_context: bool = False,
       validate_dc_responses: bool = False,
       metrics_list: str = '',
+      validation_chunk_size: int = validate.DEFAULT_CHUNK_SIZE,
+      validation_gate: validate.ScoreGate | None = None,
+      metrics_top_k: int = 0,
+      metrics_index: retrieval.BM25Index | None = None,
+      speculation_policy: SpeculationPolicy | None = None,
   ):
     self.llm_question = llm_question
     self.llm_answer = llm_answer
@@ -44,60 +95,254 @@ class RAGFlow(base.Flow):
     self.options = base.Options(verbose=verbose)
     self.in_context = in_context
     self.validate_dc_responses = validate_dc_responses
+    self.validation_chunk_size = validation_chunk_size
+    # Skips the validation LLM for confidently scored DC responses.
+    self.validation_gate = validation_gate
+    self.verdicts = validate.new_verdict_cache()
+    if metrics_index and not metrics_list:
+      metrics_list = '\n'.join(metrics_index.metrics)
     self.metrics_list = metrics_list
+    # With metrics_top_k, only the metrics most relevant to each query go
+    # into the prompt.  Pass a saved metrics_index to skip building one.
+    self.metrics_top_k = metrics_top_k
+    if metrics_top_k and not metrics_index and metrics_list:
+      metrics_index = retrieval.BM25Index(metrics_list)
+    self.metrics_index = metrics_index
+    # With a policy, the plain-query answer used after a [NO ANSWER] starts
+    # together with the table-grounded one, instead of after it.
+    self.speculation_policy = speculation_policy
+    self.speculations = 0
+    self.speculation_hits = 0
+    self._speculation_lock = threading.Lock()
 
   def query(
       self,
       query: str,
   ) -> base.FlowResponse:
+    return base.run_stages(self, query)
+
+  def new_state(self, query: str) -> _State:
+    return _State(query=query)
+
+  def stages(self) -> list[base.Stage]:
+    return [
+        ('question', self._question_stage),
+        ('dc', self._dc_stage),
+        ('validate', self._validate_stage),
+        ('answer', self._answer_stage),
+    ]
 
+  async def aquery(self, query: str) -> base.FlowResponse:
+    return await base.arun_stages(self, query, self.astages())
+
+  def astages(self) -> list[base.AsyncStage]:
+    """Async versions of `stages`; LLM and DC calls don't block the loop."""
+    return [
+        ('question', self._aquestion_stage),
+        ('dc', self._adc_stage),
+        ('validate', self._avalidate_stage),
+        ('answer', self._aanswer_stage),
+    ]
+
+  def _question_stage(self, state: _State) -> None:
+    ques_resp = self.llm_question.query(self._question_prompt(state.query))
+    self._set_questions(state, ques_resp)
+
+  async def _aquestion_stage(self, state: _State) -> None:
+    ques_resp = await base.aquery(
+        self.llm_question, self._question_prompt(state.query)
+    )
+    self._set_questions(state, ques_resp)
+
+  def _question_prompt(self, query: str) -> str:
     #
     # First call FT or V LLM model to get questions for Retrieval
     #
     if self.in_context:
       if self.metrics_list:
         prompt = prompts.RAG_IN_CONTEXT_PROMPT_WITH_VARS
-        self.options.vlog(
-            '... [RAG] Calling UNTUNED model for DC '
-            'questions with all DC vars in prompt'
-        )
-        ques_resp = self.llm_question.query(
-            prompt.format(metrics_list=self.metrics_list, sentence=query)
+        if self.metrics_top_k and self.metrics_index:
+          self.options.vlog(
+              '... [RAG] Calling UNTUNED model for DC questions with the top'
+              f' {self.metrics_top_k} matching DC vars in prompt'
+          )
+        else:
+          self.options.vlog(
+              '... [RAG] Calling UNTUNED model for DC '
+              'questions with all DC vars in prompt'
+          )
+        return prompt.format(
+            metrics_list=self._metrics_for(query), sentence=query
         )
-      else:
-        prompt = prompts.RAG_IN_CONTEXT_PROMPT
-        self.options.vlog('... [RAG] Calling UNTUNED model for DC questions')
-        ques_resp = self.llm_question.query(prompt.format(sentence=query))
+      prompt = prompts.RAG_IN_CONTEXT_PROMPT
+      self.options.vlog('... [RAG] Calling UNTUNED model for DC questions')
     else:
       prompt = prompts.RAG_FINE_TUNED_PROMPT
       self.options.vlog('... [RAG] Calling FINETUNED model for DC questions')
-      ques_resp = self.llm_question.query(prompt.format(sentence=query))
-    llm_calls = [ques_resp]
+    return prompt.format(sentence=query)
+
+  def _metrics_for(self, query: str) -> str:
+    """Returns the part of the metrics list to put in the prompt."""
+    if not self.metrics_top_k or not self.metrics_index:
+      return self.metrics_list
+    metrics = self.metrics_index.search(query, self.metrics_top_k)
+    if not metrics:
+      self.options.vlog('... [RAG] No matching metrics, using all of them')
+      return self.metrics_list
+    selected = '\n'.join(metrics)
+    self.options.vlog(
+        f'... [RAG] Using {len(metrics)} of {len(self.metrics_index)}'
+        f' metrics, {len(selected)} of {len(self.metrics_list)} chars'
+        f' ({1 - len(selected) / len(self.metrics_list):.1%} smaller)'
+    )
+    return selected
+
+  def _set_questions(self, state: _State, ques_resp: base.LLMCall) -> None:
+    state.llm_calls.append(ques_resp)
     if not ques_resp.response:
-      return base.FlowResponse(llm_calls=llm_calls)
+      state.response = base.FlowResponse(llm_calls=state.llm_calls)
+      return
 
     questions = [q.strip() for q in ques_resp.response.split('\n') if q.strip()]
-    questions = list(set(questions))[:_MAX_QUESTIONS]
+    # Dedupes in order, so that the tables, and so the final prompt, don't
+    # depend on the hash seed.
+    state.questions = list(dict.fromkeys(questions))[:_MAX_QUESTIONS]
 
+  def _dc_stage(self, state: _State) -> None:
     self.options.vlog('... [RAG] Making DC Calls')
     start = time.time()
     try:
-      q2resp = self.data_fetcher.calln(questions, self.data_fetcher.table)
+      state.q2resp = self.data_fetcher.calln(
+          state.questions, self.data_fetcher.table
+      )
     except Exception as e:
       logging.warning(e)
-      q2resp = {}
+      state.q2resp = {}
       pass
-    dc_duration = time.time() - start
+    state.dc_duration_secs = time.time() - start
 
+  async def _adc_stage(self, state: _State) -> None:
+    self.options.vlog('... [RAG] Making DC Calls')
+    start = time.time()
+    try:
+      state.q2resp = await self.data_fetcher.acalln(
+          state.questions, self.data_fetcher.atable
+      )
+    except Exception as e:
+      logging.warning(e)
+      state.q2resp = {}
+    state.dc_duration_secs = time.time() - start
+
+  def _validate_stage(self, state: _State) -> None:
     if self.validate_dc_responses:
-      q2resp = validate.run_validation(
-          q2resp, self.llm_answer, self.options, llm_calls
+      state.q2resp = validate.run_validation(
+          state.q2resp,
+          self.llm_answer,
+          self.options,
+          state.llm_calls,
+          chunk_size=self.validation_chunk_size,
+          verdicts=self.verdicts,
+          gate=self.validation_gate,
+      )
+
+  async def _avalidate_stage(self, state: _State) -> None:
+    if self.validate_dc_responses:
+      state.q2resp = await validate.arun_validation(
+          state.q2resp,
+          self.llm_answer,
+          self.options,
+          state.llm_calls,
+          chunk_size=self.validation_chunk_size,
+          verdicts=self.verdicts,
+          gate=self.validation_gate,
+      )
+
+  def _answer_stage(self, state: _State) -> None:
+    final_prompt, tables_str, dc_calls = self._final_prompt(state)
+
+    fallback = None
+    if self._speculate(state.query, final_prompt, dc_calls):
+      fallback = _get_executor().submit(
+          tracing.wrap(self.llm_answer.query), state.query
       )
+    try:
+      self.options.vlog('... [RAG] Calling UNTUNED model for final response')
+      ans_resp = self.llm_answer.query(final_prompt)
+      state.llm_calls.append(ans_resp)
+
+      if '[NO ANSWER]' in ans_resp.response:
+        self.options.vlog('... [RAG] Retrying original query!')
+        if fallback:
+          self._speculation_hit()
+          ans_resp = fallback.result()
+        else:
+          ans_resp = self.llm_answer.query(state.query)
+        state.llm_calls.append(ans_resp)
+    finally:
+      if fallback:
+        # Discarded if still running.
+        fallback.cancel()
 
+    _set_answer(state, ans_resp, tables_str, dc_calls)
+
+  async def _aanswer_stage(self, state: _State) -> None:
+    final_prompt, tables_str, dc_calls = self._final_prompt(state)
+
+    fallback = None
+    if self._speculate(state.query, final_prompt, dc_calls):
+      fallback = asyncio.create_task(
+          base.aquery(self.llm_answer, state.query)
+      )
+    try:
+      self.options.vlog('... [RAG] Calling UNTUNED model for final response')
+      ans_resp = await base.aquery(self.llm_answer, final_prompt)
+      state.llm_calls.append(ans_resp)
+
+      if '[NO ANSWER]' in ans_resp.response:
+        self.options.vlog('... [RAG] Retrying original query!')
+        if fallback:
+          self._speculation_hit()
+          ans_resp = await fallback
+        else:
+          ans_resp = await base.aquery(self.llm_answer, state.query)
+        state.llm_calls.append(ans_resp)
+    finally:
+      if fallback:
+        fallback.cancel()
+
+    _set_answer(state, ans_resp, tables_str, dc_calls)
+
+  def _speculate(
+      self,
+      query: str,
+      final_prompt: str,
+      dc_calls: list[base.DataCommonsCall],
+  ) -> bool:
+    """Returns whether to start the fallback answer now."""
+    # Without tables, the final prompt is already the plain query.
+    if not self.speculation_policy or final_prompt == query:
+      return False
+    if not self.speculation_policy(dc_calls):
+      return False
+    self.options.vlog('... [RAG] Speculatively answering original query')
+    with self._speculation_lock:
+      self.speculations += 1
+    _SPECULATIONS.labels('started').inc()
+    return True
+
+  def _speculation_hit(self) -> None:
+    with self._speculation_lock:
+      self.speculation_hits += 1
+    _SPECULATIONS.labels('used').inc()
+
+  def _final_prompt(
+      self, state: _State
+  ) -> tuple[str, str, list[base.DataCommonsCall]]:
+    """Returns the final prompt, its tables and the DC calls they came from."""
     table_parts: list[str] = []
     table_titles = set()
     dc_calls = []
-    for resp in q2resp.values():
+    for resp in state.q2resp.values():
       tidx = len(dc_calls) + 1
       if resp.table and resp.title not in table_titles:
         table_parts.append(f'Table {tidx}: {resp.answer()}')
@@ -107,30 +352,40 @@ class RAGFlow(base.Flow):
     if table_parts:
       prompt = prompts.RAG_FINAL_ANSWER_PROMPT
       tables_str = '\n'.join(table_parts)
-      final_prompt = prompt.format(sentence=query, table_str=tables_str)
+      final_prompt = prompt.format(sentence=state.query, table_str=tables_str)
     else:
       self.options.vlog('... [RAG] No stats found!')
-      final_prompt = query
+      final_prompt = state.query
       tables_str = ''
+    return final_prompt, tables_str, dc_calls
 
-    self.options.vlog('... [RAG] Calling UNTUNED model for final response')
-    ans_resp = self.llm_answer.query(final_prompt)
-    llm_calls.append(ans_resp)
 
-    if '[NO ANSWER]' in ans_resp.response:
-      self.options.vlog('... [RAG] Retrying original query!')
-      ans_resp = self.llm_answer.query(query)
-      llm_calls.append(ans_resp)
+def _set_answer(
+    state: _State,
+    ans_resp: base.LLMCall,
+    tables_str: str,
+    dc_calls: list[base.DataCommonsCall],
+) -> None:
+  if not ans_resp.response:
+    state.response = base.FlowResponse(
+        llm_calls=state.llm_calls, dc_duration_secs=state.dc_duration_secs
+    )
+    return
 
-    if not ans_resp.response:
-      return base.FlowResponse(
-          llm_calls=llm_calls, dc_duration_secs=dc_duration
-      )
+  state.response = base.FlowResponse(
+      main_text=ans_resp.response,
+      tables_str=tables_str,
+      llm_calls=state.llm_calls,
+      dc_duration_secs=state.dc_duration_secs,
+      dc_calls=dc_calls,
+  )
 
-    return base.FlowResponse(
-        main_text=ans_resp.response,
-        tables_str=tables_str,
-        llm_calls=llm_calls,
-        dc_duration_secs=dc_duration,
-        dc_calls=dc_calls,
-    )
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      _executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=_MAX_WORKERS, thread_name_prefix='rag-speculate'
+      )
+    return _executor
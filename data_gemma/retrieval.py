@@ -0,0 +1,100 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lexical retrieval over the RAG metrics list."""
+
+import collections
+import heapq
+import math
+import pickle
+import re
+
+# Standard BM25 parameters.
+_K1 = 1.5
+_B = 0.75
+
+_STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'by', 'for', 'from', 'how', 'in',
+    'is', 'it', 'me', 'of', 'on', 'or', 'tell', 'the', 'to', 'what', 'which',
+    'with',
+])
+
+
+def tokenize(text: str) -> list[str]:
+  """Returns lowercased word tokens, without stop words or plural 's'."""
+  tokens = []
+  for t in re.findall(r'[a-z0-9]+', text.lower()):
+    if t in _STOP_WORDS:
+      continue
+    if len(t) > 3 and t.endswith('s') and not t.endswith('ss'):
+      t = t[:-1]
+    tokens.append(t)
+  return tokens
+
+
+class BM25Index:
+  """An in-memory BM25 index over the lines of a metrics list.
+
+  The index is built once, and pickles to a file (see `save` and `load`)
+  so that large lists needn't be re-indexed at startup.
+  """
+
+  def __init__(self, metrics_list: str, k1: float = _K1, b: float = _B):
+    self.metrics = [m.strip() for m in metrics_list.split('\n') if m.strip()]
+    self.k1 = k1
+    self.b = b
+
+    # Sparse term -> [(metric index, term frequency)] postings.
+    self._postings: dict[str, list[tuple[int, int]]] = {}
+    doc_lens = []
+    for i, metric in enumerate(self.metrics):
+      tokens = tokenize(metric)
+      doc_lens.append(len(tokens))
+      for term, tf in collections.Counter(tokens).items():
+        self._postings.setdefault(term, []).append((i, tf))
+    avg_len = sum(doc_lens) / len(doc_lens) if doc_lens else 0.0
+    self._len_norms = [
+        k1 * (1 - b + b * n / avg_len) if avg_len else k1 for n in doc_lens
+    ]
+    num_docs = len(self.metrics)
+    self._idf = {
+        term: math.log(1 + (num_docs - len(p) + 0.5) / (len(p) + 0.5))
+        for term, p in self._postings.items()
+    }
+
+  def __len__(self) -> int:
+    return len(self.metrics)
+
+  def search(self, query: str, top_k: int) -> list[str]:
+    """Returns up to top_k metrics matching query, best first."""
+    scores: dict[int, float] = collections.defaultdict(float)
+    for term in set(tokenize(query)):
+      idf = self._idf.get(term)
+      if idf is None:
+        continue
+      for i, tf in self._postings[term]:
+        scores[i] += idf * tf * (self.k1 + 1) / (tf + self._len_norms[i])
+    best = heapq.nlargest(top_k, scores.items(), key=lambda x: (x[1], -x[0]))
+    return [self.metrics[i] for i, _ in best]
+
+  def save(self, path: str) -> None:
+    with open(path, 'wb') as f:
+      pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+  @classmethod
+  def load(cls, path: str) -> 'BM25Index':
+    with open(path, 'rb') as f:
+      index = pickle.load(f)
+    if not isinstance(index, cls):
+      raise TypeError(f'{path} does not hold a {cls.__name__}')
+    return index
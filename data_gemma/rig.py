@@ -13,21 +13,50 @@
 # limitations under the License.
 """RIG Flow."""
 
-import copy
+import collections
+import concurrent.futures
+import dataclasses
 import logging
 import re
+import threading
 import time
 
 from data_gemma import base
 from data_gemma import datacommons
 from data_gemma import prompts
+from data_gemma import tracing
 from data_gemma import validate
 
 _DC_PATTERN = r'\[__DC__\("([^"]+)"\) --> "([^"]*)"\]?'
 
+# The query part of a `_DC_PATTERN` marker, which is enough to start a DC
+# call while the rest of the response is still streaming.
+_DC_QUERY_PATTERN = re.compile(r'\[__DC__\("([^"]+)"\)')
+
+# A complete `_DC_PATTERN` marker, which is what `_evaluate` replaces.
+_DC_MARKER_PATTERN = re.compile(r'\[__DC__\("([^"]+)"\) --> "([^"]*)"\]')
+
+# Splits a streamed response into paragraphs for pipelined annotation.
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
 # 5% threshold
 _DIFF_THRESHOLD = 0.05
 
+# Threads annotating paragraphs.
+_MAX_WORKERS = 8
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class _State(base.FlowState):
+  # The LLM response with `__DC__` annotations.
+  llm_text: str = ''
+  q2llmval: dict[str, list[str]] = dataclasses.field(default_factory=dict)
+  # Set when the DC calls were made while generating.
+  dc_done: bool = False
+
 
 class RIGFlow(base.Flow):
   """Retrieval Interleaved Answering."""
@@ -40,6 +69,10 @@ class RIGFlow(base.Flow):
       verbose: bool = True,
       in_context: bool = False,
       validate_dc_responses: bool = False,
+      stream: bool = False,
+      validation_chunk_size: int = validate.DEFAULT_CHUNK_SIZE,
+      validation_gate: validate.ScoreGate | None = None,
+      pipeline_paragraphs: bool = False,
   ):
     self.llm = llm
     self.annotator_llm = annotator_llm
@@ -47,6 +80,15 @@ class RIGFlow(base.Flow):
     self.options = base.Options(verbose=verbose)
     self.in_context = in_context
     self.validate_dc_responses = validate_dc_responses
+    self.validation_chunk_size = validation_chunk_size
+    # Skips the validation LLM for confidently scored DC responses.
+    self.validation_gate = validation_gate
+    self.verdicts = validate.new_verdict_cache()
+    # Start DC calls as soon as their markers stream out of the LLM.
+    self.stream = stream
+    # With in_context, annotate each paragraph as soon as the base model
+    # finishes it, rather than the whole response at the end.
+    self.pipeline_paragraphs = pipeline_paragraphs
     assert (not self.in_context or
             self.annotator_llm), '--in_context requires annotator_llm!'
 
@@ -54,44 +96,159 @@ class RIGFlow(base.Flow):
       self,
       query: str,
   ) -> base.FlowResponse:
+    return base.run_stages(self, query)
+
+  def new_state(self, query: str) -> _State:
+    return _State(query=query)
+
+  def stages(self) -> list[base.Stage]:
+    return [
+        ('question', self._generate_stage),
+        ('dc', self._dc_stage),
+        ('validate', self._validate_stage),
+        ('answer', self._answer_stage),
+    ]
+
+  async def aquery(self, query: str) -> base.FlowResponse:
+    return await base.arun_stages(self, query, self.astages())
+
+  def astages(self) -> list[base.AsyncStage]:
+    """Async versions of `stages`; LLM and DC calls don't block the loop."""
+
+    async def _answer_stage(state: _State) -> None:
+      self._answer_stage(state)
+
+    return [
+        ('question', self._agenerate_stage),
+        ('dc', self._adc_stage),
+        ('validate', self._avalidate_stage),
+        ('answer', _answer_stage),
+    ]
+
+  def _generate_stage(self, state: _State) -> None:
+    """Gets the `__DC__` annotated response from the LLM(s)."""
+
+    if self.in_context and self.pipeline_paragraphs:
+      self._pipelined_generate(state)
+      return
 
     if self.in_context:
       self.options.vlog('... [RIG] Calling UNTUNED BASE Model for answer')
-      llm_resp = self.llm.query(query)
-      llm_calls = [llm_resp]
-      if llm_resp.response:
-        self.options.vlog('... [RIG] Calling LARGE Model for annotation')
-        prompt = prompts.RIG_IN_CONTEXT_PROMPT
-        llm_resp = self.annotator_llm.query(
-            prompt.format(text=llm_resp.response))
-        llm_calls.append(llm_resp)
+      llm_resp = self.llm.query(state.query)
+      state.llm_calls.append(llm_resp)
+      if not llm_resp.response:
+        logging.error('FAILED: %s', state.query)
+        state.response = base.FlowResponse(llm_calls=state.llm_calls)
+        return
+      self.options.vlog('... [RIG] Calling LARGE Model for annotation')
+      dc_llm = self.annotator_llm
+      dc_prompt = prompts.RIG_IN_CONTEXT_PROMPT.format(text=llm_resp.response)
     else:
       self.options.vlog('... [RIG] Calling FINETUNED Model')
-      llm_resp = self.llm.query(query)
-      llm_calls = [llm_resp]
+      dc_llm = self.llm
+      dc_prompt = state.query
+
+    if self.stream:
+      # Make DC calls while the LLM is still generating.
+      llm_resp, state.q2llmval, state.q2resp, state.dc_duration_secs = (
+          self._stream_and_call_dc(dc_llm, dc_prompt)
+      )
+      state.dc_done = True
+    else:
+      llm_resp = dc_llm.query(dc_prompt)
+    state.llm_calls.append(llm_resp)
     if not llm_resp.response:
-      logging.error('FAILED: %s', query)
-      return base.FlowResponse(llm_calls=llm_calls)
+      logging.error('FAILED: %s', state.query)
+      state.response = base.FlowResponse(llm_calls=state.llm_calls)
+      return
+    state.llm_text = llm_resp.response
 
+  async def _agenerate_stage(self, state: _State) -> None:
+    """Async version of `_generate_stage`, which doesn't stream."""
+
+    if self.in_context:
+      self.options.vlog('... [RIG] Calling UNTUNED BASE Model for answer')
+      llm_resp = await base.aquery(self.llm, state.query)
+      state.llm_calls.append(llm_resp)
+      if not llm_resp.response:
+        logging.error('FAILED: %s', state.query)
+        state.response = base.FlowResponse(llm_calls=state.llm_calls)
+        return
+      self.options.vlog('... [RIG] Calling LARGE Model for annotation')
+      llm_resp = await base.aquery(
+          self.annotator_llm,
+          prompts.RIG_IN_CONTEXT_PROMPT.format(text=llm_resp.response),
+      )
+    else:
+      self.options.vlog('... [RIG] Calling FINETUNED Model')
+      llm_resp = await base.aquery(self.llm, state.query)
+    state.llm_calls.append(llm_resp)
+    if not llm_resp.response:
+      logging.error('FAILED: %s', state.query)
+      state.response = base.FlowResponse(llm_calls=state.llm_calls)
+      return
+    state.llm_text = llm_resp.response
+
+  def _dc_stage(self, state: _State) -> None:
+    if state.dc_done:
+      # Already done while generating.
+      return
     # Make DC calls.
-    llm_text = llm_resp.response
-    q2llmval, q2resp, dc_duration = self._call_dc(llm_text)
+    state.q2llmval, state.q2resp, state.dc_duration_secs = self._call_dc(
+        state.llm_text
+    )
+
+  async def _adc_stage(self, state: _State) -> None:
+    start = time.time()
+    state.q2llmval = _dc_markers(state.llm_text)
+    try:
+      state.q2resp = await self.data_fetcher.acalln(
+          list(state.q2llmval.keys()), self.data_fetcher.apoint
+      )
+    except Exception as e:
+      logging.warning(e)
+      state.q2resp = {}
+    state.dc_duration_secs = time.time() - start
 
+  def _validate_stage(self, state: _State) -> None:
     # Sanity check DC call and response using LLM, and keep only the "good"
     # ones.
     if self.validate_dc_responses:
-      q2resp = validate.run_validation(q2resp, self.llm, self.options,
-                                       llm_calls)
-
+      state.q2resp = validate.run_validation(
+          state.q2resp,
+          self.llm,
+          self.options,
+          state.llm_calls,
+          chunk_size=self.validation_chunk_size,
+          verdicts=self.verdicts,
+          gate=self.validation_gate,
+      )
+
+  async def _avalidate_stage(self, state: _State) -> None:
+    if self.validate_dc_responses:
+      state.q2resp = await validate.arun_validation(
+          state.q2resp,
+          self.llm,
+          self.options,
+          state.llm_calls,
+          chunk_size=self.validation_chunk_size,
+          verdicts=self.verdicts,
+          gate=self.validation_gate,
+      )
+
+  def _answer_stage(self, state: _State) -> None:
     self.options.vlog('... [RIG] Calling DC Evaluate')
-    llm_text, footnotes, dc_calls = self._evaluate(llm_text, q2llmval, q2resp)
+    llm_text, footnotes, dc_calls, segments = self._evaluate(
+        state.llm_text, state.q2llmval, state.q2resp
+    )
 
-    return base.FlowResponse(
+    state.response = base.FlowResponse(
         main_text=llm_text,
         footnotes='\n'.join(footnotes),
-        llm_calls=llm_calls,
-        dc_duration_secs=dc_duration,
+        llm_calls=state.llm_calls,
+        dc_duration_secs=state.dc_duration_secs,
         dc_calls=dc_calls,
+        segments=segments,
     )
 
   def _call_dc(
@@ -101,9 +258,7 @@ class RIGFlow(base.Flow):
 
     start = time.time()
 
-    q2llmval: dict[str, list[str]] = {}
-    for match in re.findall(_DC_PATTERN, llm_text):
-      q2llmval.setdefault(match[0], []).append(match[1])
+    q2llmval = _dc_markers(llm_text)
 
     try:
       q2resp = self.data_fetcher.calln(list(q2llmval.keys()),
@@ -115,27 +270,168 @@ class RIGFlow(base.Flow):
 
     return q2llmval, q2resp, time.time() - start
 
+  def _stream_and_call_dc(
+      self, llm: base.LLM, prompt: str
+  ) -> tuple[
+      base.LLMCall,
+      dict[str, list[str]],
+      dict[str, base.DataCommonsCall],
+      float,
+  ]:
+    """Streams from the LLM, starting DC calls for markers as they appear.
+
+    The returned DC duration only counts the wait after generation ended,
+    since that is all the DC calls add to the end-to-end latency.
+    """
+
+    futures: dict[str, concurrent.futures.Future[base.DataCommonsCall]] = {}
+    text = ''
+    pos = 0
+    llm_resp = None
+    for chunk in base.query_stream(llm, prompt):
+      if isinstance(chunk, base.LLMCall):
+        llm_resp = chunk
+        break
+      text += chunk
+      for match in _DC_QUERY_PATTERN.finditer(text, pos):
+        q = match.group(1)
+        if q not in futures:
+          self.options.vlog(f'... [RIG] Early DC call for "{q}"')
+          futures[q] = self.data_fetcher.submit(q, self.data_fetcher.point)
+        pos = match.end()
+
+    start = time.time()
+    q2llmval: dict[str, list[str]] = {}
+    q2resp: dict[str, base.DataCommonsCall] = {}
+    if llm_resp and llm_resp.response:
+      q2llmval = _dc_markers(llm_resp.response)
+      q2resp = self._collect_dc(q2llmval, futures)
+    else:
+      llm_resp = llm_resp or base.LLMCall(
+          prompt=prompt, response='', duration_secs=0, error='Empty stream'
+      )
+    return llm_resp, q2llmval, q2resp, time.time() - start
+
+  def _pipelined_generate(self, state: _State) -> None:
+    """Annotates each paragraph of the streamed base response in parallel.
+
+    DC calls for a paragraph start as soon as it is annotated.  As in
+    streaming mode, the DC duration only counts the wait at the end.
+    """
+
+    self.options.vlog('... [RIG] Streaming UNTUNED BASE Model for answer')
+    dc_futures: dict[str, concurrent.futures.Future[base.DataCommonsCall]] = {}
+    dc_lock = threading.Lock()
+
+    def _annotate(paragraph: str) -> tuple[base.LLMCall, str]:
+      resp = self.annotator_llm.query(
+          prompts.RIG_IN_CONTEXT_PROMPT.format(text=paragraph)
+      )
+      if not resp.response:
+        # Keep the paragraph without annotations.
+        logging.error('FAILED annotation: %s', paragraph[:50])
+        return resp, paragraph
+      annotated = resp.response.strip()
+      with dc_lock:
+        for q in _dc_markers(annotated):
+          if q not in dc_futures:
+            dc_futures[q] = self.data_fetcher.submit(
+                q, self.data_fetcher.point
+            )
+      return resp, annotated
+
+    # Paragraph annotations, and the separators between them, in order.
+    parts: list[str | concurrent.futures.Future[tuple[base.LLMCall, str]]] = []
+
+    def _add(paragraph: str) -> None:
+      if paragraph.strip():
+        self.options.vlog('... [RIG] Calling LARGE Model for a paragraph')
+        parts.append(
+            _get_executor().submit(tracing.wrap(_annotate), paragraph)
+        )
+      else:
+        parts.append(paragraph)
+
+    text = ''
+    llm_resp = None
+    for chunk in base.query_stream(self.llm, state.query):
+      if isinstance(chunk, base.LLMCall):
+        llm_resp = chunk
+        break
+      text += chunk
+      while match := _PARAGRAPH_BREAK.search(text):
+        _add(text[:match.start()])
+        parts.append(match.group())
+        text = text[match.end():]
+    _add(text)
+
+    llm_resp = llm_resp or base.LLMCall(
+        prompt=state.query, response='', duration_secs=0, error='Empty stream'
+    )
+    state.llm_calls.append(llm_resp)
+    if not llm_resp.response:
+      logging.error('FAILED: %s', state.query)
+      state.response = base.FlowResponse(llm_calls=state.llm_calls)
+      return
+
+    texts = []
+    for part in parts:
+      if isinstance(part, str):
+        texts.append(part)
+        continue
+      annotation, annotated = part.result()
+      state.llm_calls.append(annotation)
+      texts.append(annotated)
+    state.llm_text = ''.join(texts)
+
+    start = time.time()
+    state.q2llmval = _dc_markers(state.llm_text)
+    state.q2resp = self._collect_dc(state.q2llmval, dc_futures)
+    state.dc_duration_secs = time.time() - start
+    state.dc_done = True
+
+  def _collect_dc(
+      self,
+      q2llmval: dict[str, list[str]],
+      futures: dict[str, concurrent.futures.Future[base.DataCommonsCall]],
+  ) -> dict[str, base.DataCommonsCall]:
+    """Waits for the DC calls of q2llmval, starting any not yet started."""
+    q2resp: dict[str, base.DataCommonsCall] = {}
+    for i, q in enumerate(q2llmval):
+      if q not in futures:
+        futures[q] = self.data_fetcher.submit(q, self.data_fetcher.point)
+      q2resp[q] = futures[q].result()
+      q2resp[q].id = i + 1
+    return q2resp
+
   def _evaluate(
       self,
       text: str,
       q2llmval: dict[str, list[str]],
       q2resp: dict[str, base.DataCommonsCall],
-  ) -> tuple[str, list[str], list[base.DataCommonsCall]]:
-    """Evaluates a text contained DC Calls."""
+  ) -> tuple[
+      str, list[str], list[base.DataCommonsCall], list[base.Segment]
+  ]:
+    """Evaluates a text contained DC Calls.
 
-    def _rtag(txt: str, r: base.DataCommonsCall) -> str:
-      return f'[{base.DC}#{r.id}({txt})]'
+    DC calls get ids in `q2resp` order, and the n-th call for a (query, LLM
+    value) pair replaces the n-th marker for it in the text.  The text is
+    then rewritten in a single pass over the markers.
+    """
 
     dc_calls = []
     footnote_map = {}
+    replacements: dict[
+        tuple[str, str], collections.deque[tuple[str, base.DataCommonsCall]]
+    ] = {}
     for q, orig_resp in q2resp.items():
       llm_vals = q2llmval[q]
 
       for llmval in llm_vals:
-        resp = copy.deepcopy(orig_resp)
-
-        resp.id = len(dc_calls) + 1
-        resp.llm_val = llmval
+        # All fields are immutable, so a shallow copy is enough.
+        resp = dataclasses.replace(
+            orig_resp, id=len(dc_calls) + 1, llm_val=llmval
+        )
         dcval = resp.val_and_unit()
 
         idx = -1
@@ -146,31 +442,62 @@ class RIGFlow(base.Flow):
           else:
             idx = footnote_map[q][0]
 
-        orig = f'[__DC__("{q}") --> "{llmval}"]'
         if not llmval:
           # If LLM answer was empty!
           if dcval:
             new = f'{dcval} [{idx}] ||'
           else:
             new = '--- || ---'
-          text = text.replace(orig, _rtag(new, resp), 1)
         elif dcval:
           if _flag_value(resp.val, llmval):
             new = f'{dcval} [{idx}]* || {llmval}'
           else:
             new = f'{dcval} [{idx}] || {llmval}'
-          text = text.replace(orig, _rtag(new, resp), 1)
         else:
           new = f'|| {llmval}'
-          text = text.replace(orig, _rtag(new, resp), 1)
+        replacements.setdefault((q, llmval), collections.deque()).append(
+            (new, resp)
+        )
 
         dc_calls.append(resp)
 
+    parts: list[str] = []
+    segments: list[base.Segment] = []
+
+    def _add(out: str, seg_text: str, dc_call_id: int = 0) -> None:
+      start = segments[-1].end if segments else 0
+      parts.append(out)
+      segments.append(
+          base.Segment(seg_text, start, start + len(out), dc_call_id)
+      )
+
+    pos = 0
+    for match in _DC_MARKER_PATTERN.finditer(text):
+      pending = replacements.get(match.groups())
+      if not pending:
+        continue
+      new, resp = pending.popleft()
+      if match.start() > pos:
+        plain = text[pos:match.start()]
+        _add(plain, plain)
+      _add(f'[{base.DC}#{resp.id}({new})]', new, resp.id)
+      pos = match.end()
+    if pos < len(text):
+      _add(text[pos:], text[pos:])
+
     footnotes = [
         v[1] for v in sorted(footnote_map.values(), key=lambda x: x[0])
     ]
 
-    return text, footnotes, dc_calls
+    return ''.join(parts), footnotes, dc_calls, segments
+
+
+def _dc_markers(llm_text: str) -> dict[str, list[str]]:
+  """Returns the LLM values of each `__DC__` query in llm_text."""
+  q2llmval: dict[str, list[str]] = {}
+  for match in re.findall(_DC_PATTERN, llm_text):
+    q2llmval.setdefault(match[0], []).append(match[1])
+  return q2llmval
 
 
 def _clean_float(text: str) -> float:
@@ -194,3 +521,13 @@ def _flag_value(dcv: str, llmv: str) -> bool:
   except:
     return False
   return pct_diff > _DIFF_THRESHOLD or pct_diff < -_DIFF_THRESHOLD
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      _executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=_MAX_WORKERS, thread_name_prefix='rig-annotate'
+      )
+    return _executor
@@ -0,0 +1,102 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Coalescing of concurrent identical calls."""
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable
+
+
+class _Call:
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result: Any = None
+    self.error: BaseException | None = None
+
+
+class SingleFlight:
+  """Runs at most one call per key at a time.
+
+  Callers that arrive while a call for the same key is in flight wait for
+  it and share its result (or exception) instead of making their own.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls: dict[str, _Call] = {}
+    self._acalls: dict[tuple[asyncio.AbstractEventLoop, str], asyncio.Task] = (
+        {}
+    )
+    # Number of calls that were served by another caller's in-flight call.
+    self.coalesced = 0
+
+  def do(self, key: str, fn: Callable[[], Any]) -> Any:
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = _Call()
+        self._calls[key] = call
+      else:
+        self.coalesced += 1
+    if not leader:
+      call.done.wait()
+      if call.error:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = fn()
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+  async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """Async version of `do`.  Calls are only shared within an event loop.
+
+    The call runs in its own task, so that cancelling any caller, including
+    the one that started it, does not cancel it for the others.
+    """
+    loop = asyncio.get_running_loop()
+    akey = (loop, key)
+    task = self._acalls.get(akey)
+    if task:
+      with self._lock:
+        self.coalesced += 1
+    else:
+      task = loop.create_task(self._arun(akey, fn))
+      # Marks the exception retrieved, in case every caller was cancelled.
+      task.add_done_callback(lambda t: t.cancelled() or t.exception())
+      self._acalls[akey] = task
+    return await asyncio.shield(task)
+
+  async def _arun(
+      self,
+      akey: tuple[asyncio.AbstractEventLoop, str],
+      fn: Callable[[], Awaitable[Any]],
+  ) -> Any:
+    try:
+      return await fn()
+    finally:
+      del self._acalls[akey]
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {'coalesced': self.coalesced, 'in_flight': len(self._calls)}
@@ -0,0 +1,362 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lightweight tracing of flows, stages, and LLM and DC requests.
+
+Tracing is off by default, in which case `span` returns a shared no-op.
+
+  tracing.enable()
+  flow.query('...')
+  tracing.export_chrome('/tmp/trace.json')  # Open in chrome://tracing.
+
+Only the latest `max_spans` ended spans are kept (see `enable`); long runs
+can also export with `drain=True` to write and forget them periodically.
+"""
+
+import collections
+import contextvars
+import dataclasses
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, TypeVar
+
+from data_gemma import metrics
+
+_T = TypeVar('_T')
+
+_LLM_REQUESTS = metrics.counter(
+    'data_gemma_llm_requests_total',
+    'LLM calls by backend, method and outcome (ok, error or cached).',
+    ('backend', 'method', 'outcome'),
+)
+_LLM_SECONDS = metrics.histogram(
+    'data_gemma_llm_request_seconds',
+    'Latency of uncached LLM calls.',
+    ('backend', 'method'),
+)
+_LLM_TTFT_SECONDS = metrics.histogram(
+    'data_gemma_llm_ttft_seconds',
+    'Time to first token of streamed LLM calls.',
+    ('backend', 'method'),
+)
+
+# Older spans are dropped beyond this, so tracing a long run can't exhaust
+# memory.
+_MAX_SPANS = 100_000
+
+_enabled = False
+_spans: collections.deque['Span'] = collections.deque(maxlen=_MAX_SPANS)
+_spans_lock = threading.Lock()
+_ids = itertools.count(1)
+
+_current: contextvars.ContextVar['Span | None'] = contextvars.ContextVar(
+    'data_gemma_span', default=None
+)
+
+
+@dataclasses.dataclass
+class Span:
+  """A timed operation, with a parent in the same trace."""
+
+  name: str
+  span_id: int
+  parent_id: int
+  trace_id: int
+  start_secs: float
+  end_secs: float = 0.0
+  thread: str = ''
+  attrs: dict[str, Any] = dataclasses.field(default_factory=dict)
+
+  def set(self, **attrs: Any) -> None:
+    self.attrs.update(attrs)
+
+  def end(self) -> None:
+    """Ends the span and records it."""
+    self.end_secs = time.time()
+    with _spans_lock:
+      _spans.append(self)
+
+  def __enter__(self) -> 'Span':
+    self._token = _current.set(self)
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    _current.reset(self._token)
+    if exc is not None:
+      self.attrs['error'] = repr(exc)
+    self.end()
+
+
+class _NoopSpan:
+  """Stands in for a Span when tracing is off."""
+
+  def set(self, **attrs: Any) -> None:
+    pass
+
+  def end(self) -> None:
+    pass
+
+  def __enter__(self) -> '_NoopSpan':
+    return self
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    pass
+
+
+_NOOP = _NoopSpan()
+
+
+def enable(max_spans: int = _MAX_SPANS) -> None:
+  """Turns tracing on, keeping at most the latest max_spans spans."""
+  global _enabled, _spans
+  with _spans_lock:
+    if max_spans != _spans.maxlen:
+      _spans = collections.deque(_spans, maxlen=max_spans)
+  _enabled = True
+
+
+def disable() -> None:
+  global _enabled
+  _enabled = False
+
+
+def enabled() -> bool:
+  return _enabled
+
+
+def span(name: str, **attrs: Any) -> Span | _NoopSpan:
+  """Returns a span to use with `with`, as the parent of spans inside it."""
+  if not _enabled:
+    return _NOOP
+  return _new_span(name, _current.get(), attrs)
+
+
+def start_span(
+    name: str, parent: Span | _NoopSpan | None = None, **attrs: Any
+) -> Span | _NoopSpan:
+  """Starts a span that must be ended with `end()`.
+
+  Unlike `span`, it does not become the parent of other spans, so it suits
+  work that is suspended in between, like generators.
+  """
+  if not _enabled:
+    return _NOOP
+  if parent is None:
+    parent = _current.get()
+  if isinstance(parent, _NoopSpan):
+    parent = None
+  return _new_span(name, parent, attrs)
+
+
+def current() -> Span | _NoopSpan:
+  return _current.get() or _NOOP
+
+
+def use(parent: Span | _NoopSpan) -> Span | _NoopSpan:
+  """Returns a context manager that makes parent current, without ending it."""
+  if isinstance(parent, _NoopSpan):
+    return _NOOP
+  return _Use(parent)
+
+
+def wrap(fn: Callable[..., _T]) -> Callable[..., _T]:
+  """Returns fn bound to the current span, for running in another thread."""
+  if not _enabled:
+    return fn
+  ctx = contextvars.copy_context()
+
+  def _run(*args: Any, **kwargs: Any) -> _T:
+    return ctx.run(fn, *args, **kwargs)
+
+  return _run
+
+
+def spans() -> list[Span]:
+  """Returns the spans ended so far."""
+  with _spans_lock:
+    return list(_spans)
+
+
+def clear() -> None:
+  with _spans_lock:
+    _spans.clear()
+
+
+def export_jsonl(path: str, drain: bool = False) -> None:
+  """Writes the spans ended so far to path, one JSON object per line.
+
+  With `drain`, the written spans are also cleared.
+  """
+  with open(path, 'w') as f:
+    for s in _take(drain):
+      f.write(json.dumps(dataclasses.asdict(s), default=str) + '\n')
+
+
+def export_chrome(path: str, drain: bool = False) -> None:
+  """Writes the spans ended so far in Chrome's trace event format.
+
+  With `drain`, the written spans are also cleared.
+  """
+  pid = os.getpid()
+  events = []
+  for s in _take(drain):
+    args = dict(s.attrs, span_id=s.span_id, parent_id=s.parent_id)
+    events.append({
+        'name': s.name,
+        'ph': 'X',
+        'ts': s.start_secs * 1e6,
+        'dur': (s.end_secs - s.start_secs) * 1e6,
+        'pid': pid,
+        'tid': s.thread,
+        'args': args,
+    })
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': events}, f, default=str)
+
+
+def _take(drain: bool) -> list[Span]:
+  with _spans_lock:
+    taken = list(_spans)
+    if drain:
+      _spans.clear()
+  return taken
+
+
+def llm_call(fn: Callable[..., Any]) -> Callable[..., Any]:
+  """Decorates an LLM method to trace each call, with its sizes and timing.
+
+  Calls are also counted and timed in `metrics`, whether or not tracing is
+  enabled.  Works for methods returning an LLMCall (or a list of them), for
+  async ones, and for generators ending with an LLMCall, like
+  `query_stream`.
+  """
+  name = f'llm.{fn.__name__}'
+  method = fn.__name__
+
+  if inspect.isgeneratorfunction(fn):
+
+    @functools.wraps(fn)
+    def _gen(self, prompt, *args, **kwargs):
+      s = start_span(name, **_llm_attrs(self, prompt)) if _enabled else _NOOP
+      try:
+        for chunk in fn(self, prompt, *args, **kwargs):
+          if not isinstance(chunk, str):
+            _record_llm_metrics(self, method, chunk)
+            if _enabled:
+              s.set(**_llm_result_attrs(chunk))
+          yield chunk
+      finally:
+        s.end()
+
+    return _gen
+
+  if inspect.iscoroutinefunction(fn):
+
+    @functools.wraps(fn)
+    async def _async(self, prompt, *args, **kwargs):
+      if not _enabled:
+        result = await fn(self, prompt, *args, **kwargs)
+        _record_llm_metrics(self, method, result)
+        return result
+      with span(name, **_llm_attrs(self, prompt)) as s:
+        result = await fn(self, prompt, *args, **kwargs)
+        _record_llm_metrics(self, method, result)
+        s.set(**_llm_result_attrs(result))
+        return result
+
+    return _async
+
+  @functools.wraps(fn)
+  def _sync(self, prompt, *args, **kwargs):
+    if not _enabled:
+      result = fn(self, prompt, *args, **kwargs)
+      _record_llm_metrics(self, method, result)
+      return result
+    with span(name, **_llm_attrs(self, prompt)) as s:
+      result = fn(self, prompt, *args, **kwargs)
+      _record_llm_metrics(self, method, result)
+      s.set(**_llm_result_attrs(result))
+      return result
+
+  return _sync
+
+
+class _Use:
+
+  def __init__(self, parent: Span):
+    self.parent = parent
+
+  def __enter__(self) -> Span:
+    self._token = _current.set(self.parent)
+    return self.parent
+
+  def __exit__(self, exc_type, exc, tb) -> None:
+    _current.reset(self._token)
+
+
+def _new_span(name: str, parent: Span | None, attrs: dict[str, Any]) -> Span:
+  span_id = next(_ids)
+  return Span(
+      name=name,
+      span_id=span_id,
+      parent_id=parent.span_id if parent else 0,
+      trace_id=parent.trace_id if parent else span_id,
+      start_secs=time.time(),
+      thread=threading.current_thread().name,
+      attrs=attrs,
+  )
+
+
+def _llm_attrs(llm: Any, prompt: str | list[str]) -> dict[str, Any]:
+  attrs = {'backend': type(llm).__name__}
+  model = getattr(llm, 'model', '')
+  if isinstance(model, str) and model:
+    attrs['model'] = model
+  if isinstance(prompt, str):
+    attrs['prompt_chars'] = len(prompt)
+  else:
+    attrs['batch_size'] = len(prompt)
+    attrs['prompt_chars'] = sum(len(p) for p in prompt)
+  return attrs
+
+
+def _llm_result_attrs(result: Any) -> dict[str, Any]:
+  """Returns attributes of an LLMCall, or a list of them."""
+  calls = result if isinstance(result, list) else [result]
+  attrs = {
+      'response_chars': sum(len(c.response or '') for c in calls),
+      'cached': any(c.cached for c in calls),
+      'error': any(bool(c.error) for c in calls),
+  }
+  ttfts = [c.ttft_secs for c in calls if c.ttft_secs is not None]
+  if ttfts:
+    attrs['ttft_secs'] = min(ttfts)
+  return attrs
+
+
+def _record_llm_metrics(llm: Any, method: str, result: Any) -> None:
+  backend = type(llm).__name__
+  for c in result if isinstance(result, list) else [result]:
+    if c.cached:
+      _LLM_REQUESTS.labels(backend, method, 'cached').inc()
+      continue
+    outcome = 'error' if c.error else 'ok'
+    _LLM_REQUESTS.labels(backend, method, outcome).inc()
+    _LLM_SECONDS.labels(backend, method).observe(c.duration_secs)
+    if c.ttft_secs is not None:
+      _LLM_TTFT_SECONDS.labels(backend, method).observe(c.ttft_secs)
@@ -14,9 +14,20 @@
 
 """Utils."""
 
+import collections
 import csv
+import math
 import os
 import textwrap
+import threading
+from typing import Any, Iterator
+
+try:
+  import aiohttp  # pylint: disable=g-import-not-at-top
+except ImportError:
+  aiohttp = None
+
+from data_gemma import journal
 
 
 # Use a larger field size limit since we can have longer text in training
@@ -24,6 +35,13 @@ import textwrap
 _LARGE_FIELD_SIZE = 10485760
 
 
+def new_async_session() -> Any:
+  """Returns a new `aiohttp.ClientSession` for async API calls."""
+  if aiohttp is None:
+    raise ImportError('Async API calls need aiohttp: `pip install aiohttp`')
+  return aiohttp.ClientSession()
+
+
 def get_header(in_file):
   with open(in_file, 'r') as f:
     csvr = csv.reader(f)
@@ -43,6 +61,30 @@ def round_float(v: str) -> str:
       return v
 
 
+class LatencyWindow:
+  """A thread-safe sliding window of recent latencies, in seconds."""
+
+  def __init__(self, size: int = 1000):
+    self._samples: collections.deque[float] = collections.deque(maxlen=size)
+    self._lock = threading.Lock()
+
+  def add(self, secs: float) -> None:
+    with self._lock:
+      self._samples.append(secs)
+
+  def percentile(self, pct: float) -> float:
+    """Returns the `pct` (0-100) percentile, or 0 if there are no samples."""
+    with self._lock:
+      samples = sorted(self._samples)
+    if not samples:
+      return 0.0
+    idx = min(len(samples) - 1, max(0, math.ceil(pct / 100 * len(samples)) - 1))
+    return samples[idx]
+
+  def __len__(self) -> int:
+    return len(self._samples)
+
+
 #
 # Returns IDs from links_file that match the given statuses.
 #
@@ -52,11 +94,10 @@ def get_matched_ids(
   if not links_file or not statuses:
     return set()
   matched_ids = set()
-  with open(links_file, 'r') as f:
-    for row in csv.DictReader(f):
-      s = row.get(status_col, '')
-      if s in statuses:
-        matched_ids.add(row[id_col])
+  for row in _read_rows(links_file):
+    s = row.get(status_col, '')
+    if s in statuses:
+      matched_ids.add(row[id_col])
   return matched_ids
 
 
@@ -67,28 +108,37 @@ def load_csv(
 
   csv.field_size_limit(_LARGE_FIELD_SIZE)
   results = {}
-  if os.path.exists(csv_file):
-    with open(csv_file, 'r') as f:
-      results = {}
-      for row in csv.DictReader(f):
-        k = row[id_column].strip()
-        if aux_id_column:
-          k = f'{k}/{row[aux_id_column].strip()}'
-        if k:
-          results[k] = row
+  for row in _read_rows(csv_file):
+    k = row[id_column].strip()
+    if aux_id_column:
+      k = f'{k}/{row[aux_id_column].strip()}'
+    if k:
+      results[k] = row
   return results
 
 
 def checkpoint_csv(
     csv_file: str, key2row: dict[str, dict[str, str]], header: list[str]
 ) -> None:
-  """Checkpoint an ID keyed csv file."""
+  """Checkpoint an ID keyed csv file.
+
+  This rewrites the whole file; for long runs, `journal.Journal` only
+  appends the new rows.
+  """
   with open(csv_file, 'w', newline='') as f:
     csvw = csv.DictWriter(f, fieldnames=header)
     csvw.writeheader()
     csvw.writerows([key2row[k] for k in sorted(key2row.keys())])
 
 
+def _read_rows(csv_file: str) -> Iterator[dict[str, str]]:
+  """Yields rows of csv_file, then any rows not yet compacted into it."""
+  if os.path.exists(csv_file):
+    with open(csv_file, 'r') as f:
+      yield from csv.DictReader(f)
+  yield from journal.read_segments(csv_file)
+
+
 def clean_rig_in_context_response(text: str) -> str:
   parts = text.split('Answer:-', 1)
   if len(parts) > 1:
@@ -14,10 +14,101 @@
 
 """Validation Flow."""
 
+import asyncio
+import concurrent.futures
+import json
 import logging
+import threading
 
 from data_gemma import base
+from data_gemma import cache
+from data_gemma import metrics
 from data_gemma import prompts
+from data_gemma import tracing
+
+# `prompts.DC_QA_VALIDATION` handles up to 20 pairs.
+DEFAULT_CHUNK_SIZE = 20
+
+_MAX_VERDICTS = 10000
+_VERDICT_TTL_SECS = 24 * 60 * 60
+
+# Default ScoreGate thresholds on the DC `CosineScore`.  DC itself drops
+# matches below about 0.7 (tables) or 0.8 (points).
+_ACCEPT_SCORE = 0.9
+_REJECT_SCORE = 0.7
+
+# Threads validating chunks of the same or different flows.
+_MAX_WORKERS = 8
+
+_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+_PAIRS = metrics.counter(
+    'data_gemma_validation_pairs_total',
+    'Validated DC QA pairs by how they were decided, and the verdict.',
+    ('decided_by', 'verdict'),
+)
+_CHUNKS = metrics.counter(
+    'data_gemma_validation_chunks_total',
+    'Validation LLM calls by outcome.',
+    ('outcome',),
+)
+
+# A chunk of questions and its `DC_QA_VALIDATION` input.
+_Chunk = tuple[list[str], str]
+
+
+class ScoreGate:
+  """Decides DC responses by match score, leaving the unsure ones to the LLM.
+
+  Responses scoring at least `accept_score` are kept and those below
+  `reject_score` are dropped, without asking the LLM.  Responses without a
+  score are always left to the LLM.
+  """
+
+  def __init__(
+      self,
+      accept_score: float = _ACCEPT_SCORE,
+      reject_score: float = _REJECT_SCORE,
+  ):
+    if reject_score > accept_score:
+      raise ValueError(
+          f'reject_score {reject_score} > accept_score {accept_score}'
+      )
+    self.accept_score = accept_score
+    self.reject_score = reject_score
+    self.accepted = 0
+    self.rejected = 0
+    self.uncertain = 0
+    self._lock = threading.Lock()
+
+  def decide(self, resp: base.DataCommonsCall) -> bool | None:
+    """Returns whether to keep resp, or None to ask the LLM."""
+    with self._lock:
+      if resp.score < 0:
+        self.uncertain += 1
+        return None
+      if resp.score >= self.accept_score:
+        self.accepted += 1
+        return True
+      if resp.score < self.reject_score:
+        self.rejected += 1
+        return False
+      self.uncertain += 1
+      return None
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+          'accepted': self.accepted,
+          'rejected': self.rejected,
+          'uncertain': self.uncertain,
+      }
+
+
+def new_verdict_cache(max_entries: int = _MAX_VERDICTS) -> cache.LRU:
+  """Returns a cache of verdicts by (question, DC title), for a validator."""
+  return cache.LRU(max_entries)
 
 
 def run_validation(
@@ -25,38 +116,189 @@ def run_validation(
     llm: base.LLM,
     options: base.Options,
     llm_calls: list[base.LLMCall],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    verdicts: cache.LRU | None = None,
+    gate: ScoreGate | None = None,
 ) -> dict[str, base.DataCommonsCall]:
-  """Runs DC QA validation."""
-  queries, input_text = _dc_qa_validation_input(
-      {q: r.title for q, r in q2resp.items()}
-  )
-  if queries:
-    llm_resp2 = llm.query(prompts.DC_QA_VALIDATION.format(input=input_text))
-    options.vlog(f'... [Validate] {input_text}\n{llm_resp2.response}')
-    if not llm_resp2.response:
-      logging.error('FAILED: %s', input_text)
-      queries = []
+  """Runs DC QA validation.
+
+  Pairs are sent to the LLM in chunks of chunk_size, concurrently.  With
+  `gate`, confidently scored pairs skip the LLM, and with `verdicts`, pairs
+  seen before reuse their verdict.
+  """
+  with tracing.span('validate', pairs=len(q2resp)) as s:
+    kept, chunks = _plan(q2resp, options, chunk_size, verdicts, gate)
+    s.set(chunks=len(chunks))
+    if len(chunks) > 1:
+      validate_chunk = tracing.wrap(_validate_chunk)
+      futures = [
+          _get_executor().submit(validate_chunk, c, llm, options)
+          for c in chunks
+      ]
+      results = [f.result() for f in futures]
     else:
-      llm_calls.append(llm_resp2)
-      try:
-        onum = len(queries)
-        queries = _dc_qa_validation_check(llm_resp2.response, queries)
-        if len(queries) < onum:
-          options.vlog(
-              f'... [Validate] Dropped answers: {onum} --> {len(queries)}'
-          )
-      except:
-        logging.error('FAILED: %s', llm_resp2.response)
-        queries = []
-  else:
+      results = [_validate_chunk(c, llm, options) for c in chunks]
+    return _merge(q2resp, kept, chunks, results, llm_calls, verdicts)
+
+
+async def arun_validation(
+    q2resp: dict[str, base.DataCommonsCall],
+    llm: base.LLM,
+    options: base.Options,
+    llm_calls: list[base.LLMCall],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    verdicts: cache.LRU | None = None,
+    gate: ScoreGate | None = None,
+) -> dict[str, base.DataCommonsCall]:
+  """Async version of `run_validation`."""
+  with tracing.span('validate', pairs=len(q2resp)) as s:
+    kept, chunks = _plan(q2resp, options, chunk_size, verdicts, gate)
+    s.set(chunks=len(chunks))
+    results = await asyncio.gather(
+        *[_avalidate_chunk(c, llm, options) for c in chunks]
+    )
+    return _merge(q2resp, kept, chunks, results, llm_calls, verdicts)
+
+
+def _plan(
+    q2resp: dict[str, base.DataCommonsCall],
+    options: base.Options,
+    chunk_size: int,
+    verdicts: cache.LRU | None,
+    gate: ScoreGate | None,
+) -> tuple[set[str], list[_Chunk]]:
+  """Returns the queries kept without the LLM, and chunks for the rest."""
+  kept = set()
+  q2title = {}
+  num_cached = 0
+  num_gated = 0
+  for q, r in q2resp.items():
+    if not r.title.strip():
+      continue
+    verdict = gate.decide(r) if gate else None
+    if verdict is not None:
+      num_gated += 1
+      _PAIRS.labels('gate', _verdict_label(verdict)).inc()
+      if verdict:
+        kept.add(q)
+      continue
+    if verdicts is not None:
+      verdict = verdicts.get(_verdict_key(q, r.title))
+    if verdict is None:
+      q2title[q] = r.title
+      continue
+    num_cached += 1
+    _PAIRS.labels('cache', _verdict_label(verdict)).inc()
+    if verdict:
+      kept.add(q)
+  if num_gated:
+    options.vlog(f'... [Validate] {num_gated} decided by score')
+  if num_cached:
+    options.vlog(f'... [Validate] {num_cached} cached verdicts')
+  if not q2title and not num_cached and not num_gated:
     options.vlog('... [Validate] empty queries!')
 
-  queries = set(queries)
-  q2resp = {
-      q: r if q in queries else base.DataCommonsCall(query=q)
+  items = list(q2title.items())
+  chunk_size = max(1, chunk_size)
+  chunks = [
+      _dc_qa_validation_input(dict(items[i : i + chunk_size]))
+      for i in range(0, len(items), chunk_size)
+  ]
+  return kept, chunks
+
+
+def _validate_chunk(
+    chunk: _Chunk, llm: base.LLM, options: base.Options
+) -> tuple[base.LLMCall, list[str] | None]:
+  queries, input_text = chunk
+  llm_resp = llm.query(prompts.DC_QA_VALIDATION.format(input=input_text))
+  return llm_resp, _check(llm_resp, queries, input_text, options)
+
+
+async def _avalidate_chunk(
+    chunk: _Chunk, llm: base.LLM, options: base.Options
+) -> tuple[base.LLMCall, list[str] | None]:
+  queries, input_text = chunk
+  llm_resp = await base.aquery(
+      llm, prompts.DC_QA_VALIDATION.format(input=input_text)
+  )
+  return llm_resp, _check(llm_resp, queries, input_text, options)
+
+
+def _check(
+    llm_resp2: base.LLMCall,
+    queries: list[str],
+    input_text: str,
+    options: base.Options,
+) -> list[str] | None:
+  """Returns the queries the validation response kept, or None on failure."""
+  options.vlog(f'... [Validate] {input_text}\n{llm_resp2.response}')
+  if not llm_resp2.response:
+    logging.error('FAILED: %s', input_text)
+    return None
+  try:
+    onum = len(queries)
+    queries = _dc_qa_validation_check(llm_resp2.response, queries)
+    if len(queries) < onum:
+      options.vlog(
+          f'... [Validate] Dropped answers: {onum} --> {len(queries)}'
+      )
+  except:
+    logging.error('FAILED: %s', llm_resp2.response)
+    return None
+  return queries
+
+
+def _merge(
+    q2resp: dict[str, base.DataCommonsCall],
+    kept: set[str],
+    chunks: list[_Chunk],
+    results: list[tuple[base.LLMCall, list[str] | None]],
+    llm_calls: list[base.LLMCall],
+    verdicts: cache.LRU | None,
+) -> dict[str, base.DataCommonsCall]:
+  """Merges the chunk verdicts, and drops the responses that failed."""
+  for (queries, _), (llm_resp, chunk_kept) in zip(chunks, results):
+    if llm_resp.response:
+      llm_calls.append(llm_resp)
+    if chunk_kept is None:
+      # A failed chunk drops its responses, but is not a verdict.
+      _CHUNKS.labels('failed').inc()
+      continue
+    _CHUNKS.labels('ok').inc()
+    chunk_kept = set(chunk_kept)
+    kept.update(chunk_kept)
+    _PAIRS.labels('llm', 'keep').inc(len(chunk_kept))
+    _PAIRS.labels('llm', 'drop').inc(len(queries) - len(chunk_kept))
+    if verdicts is not None:
+      for q in queries:
+        verdicts.put(
+            _verdict_key(q, q2resp[q].title),
+            q in chunk_kept,
+            _VERDICT_TTL_SECS,
+        )
+  return {
+      q: r if q in kept else base.DataCommonsCall(query=q)
       for q, r in q2resp.items()
   }
-  return q2resp
+
+
+def _verdict_label(verdict: bool) -> str:
+  return 'keep' if verdict else 'drop'
+
+
+def _verdict_key(query: str, title: str) -> str:
+  return json.dumps([cache.normalize_query(query), title])
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      _executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=_MAX_WORKERS, thread_name_prefix='validate'
+      )
+    return _executor
 
 
 def _dc_qa_validation_input(q2a: dict[str, str]) -> tuple[list[str], str]:
@@ -23,6 +23,7 @@ AUTHOR = 'datacommons.org'
 REQUIRES_PYTHON = '>=3.10'
 VERSION = '0.0.1'
 REQUIRED = ['requests']
+EXTRAS = {'async': ['aiohttp']}
 PACKAGES = ['data_gemma']
 
 setup(
@@ -37,6 +38,7 @@ setup(
     url=URL,
     packages=PACKAGES,
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     license='Apache 2.0',
     classifiers=[